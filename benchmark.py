@@ -0,0 +1,245 @@
+import argparse
+import csv
+import json
+import platform
+import sys
+from time import perf_counter, time
+
+import cv2
+import tflite_runtime.interpreter
+
+from coral_cam import InferenceAdaptor
+from encoder import JpegEncoder
+from engine_pool import InterpreterPool
+from metrics import StageTimings
+from model_utils import ModelUtils
+from preprocess import PreprocessPlan
+from sources import open_source
+
+STAGES = ['preprocess', 'invoke', 'postprocess', 'annotate', 'encode']
+COLD_START_PHASES = ['load', 'allocate', 'first_invoke', 'steady_invoke']
+
+
+def benchmark_model(pool: InterpreterPool, model_name: str, edgetpu: bool, input_path: str, num_frames: int,
+                    warmup: int):
+    """ Runs one model over the frames of an image directory or a video file and times every stage.
+    :param pool: The interpreter pool used to build the interpreter.
+    :param model_name: The name of the model.
+    :param edgetpu: Whether to use the edgetpu or not.
+    :param input_path: A directory of images or a video file.
+    :param num_frames: The number of frames to time, the input is looped if it has fewer frames.
+    :param warmup: The number of frames to run before timing starts.
+    :return: A dict describing the run, with 'error' set if the model could not be run.
+    """
+    model_path = ModelUtils.get_model_path(model_name, edgetpu)
+    inference_type = ModelUtils.get_inference_type(model_name)
+    row = {'model': model_name, 'model_path': model_path, 'inference_type': inference_type, 'edgetpu': edgetpu,
+           'batch': 1, 'frames': 0, 'fps': 0.0, 'stages': {}, 'cold_start': None, 'error': None}
+    try:
+        interpreter = pool.get(model_path, edgetpu)
+    except Exception as e:
+        row['error'] = f'Failed to load model, reason: {e}'
+        return row
+    cold_start = pool.cold_starts.get((model_path, edgetpu))
+    if cold_start is not None:
+        row['cold_start'] = {key: value for key, value in cold_start._asdict().items() if key.endswith('_ms')}
+
+    plan = PreprocessPlan(interpreter)
+    # The same encoder, backend and default quality as the live feed.
+    encoder = JpegEncoder()
+    source = open_source(input_path, loop=True)
+    timings = StageTimings(window=num_frames)
+    busy = 0.0
+    try:
+        for i in range(warmup + num_frames):
+            frame = source.read()
+            if frame is None:
+                break
+            # Only time the frames after warm-up, and leave reading the input out of it.
+            record = timings if i >= warmup else None
+            t0 = perf_counter()
+            image, _ = InferenceAdaptor.process(interpreter, frame.image, inference_type, model_path, plan, record)
+            t1 = perf_counter()
+            encoder.encode(image)
+            t2 = perf_counter()
+            if record is not None:
+                timings.record('encode', t2 - t1)
+                busy += t2 - t0
+                row['frames'] += 1
+    except Exception as e:
+        # Report the model as failed and move on to the next one, rather than losing the whole report.
+        row['error'] = f'Failed to process frame {i}, reason: {type(e).__name__}: {e}'
+        return row
+    finally:
+        source.release()
+
+    if row['frames'] == 0:
+        row['error'] = f'No frames could be read from {input_path}'
+        return row
+    summary = timings.summary()
+    row['fps'] = row['frames'] / busy if busy > 0 else 0.0
+    row['stages'] = {stage: {key: summary[stage][key] for key in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')}
+                     for stage in STAGES if stage in summary}
+    return row
+
+
+def benchmark_batched(model_name: str, input_path: str, num_frames: int, warmup: int, batch_size: int):
+    """ Times a cpu model invoked on batches of frames, for models whose batch dimension can be resized. Only
+    preprocessing and invoking are timed, per frame, results aren't decoded.
+    :param model_name: The name of the model.
+    :param input_path: A directory of images or a video file.
+    :param num_frames: The number of frames to time, the input is looped if it has fewer frames.
+    :param warmup: The number of frames to run before timing starts.
+    :param batch_size: The number of frames per invoke.
+    :return: A dict describing the run, with 'error' set if the model could not be run.
+    """
+    model_path = ModelUtils.get_model_path(model_name, False)
+    inference_type = ModelUtils.get_inference_type(model_name)
+    row = {'model': model_name, 'model_path': model_path, 'inference_type': inference_type, 'edgetpu': False,
+           'batch': batch_size, 'frames': 0, 'fps': 0.0, 'stages': {}, 'cold_start': None, 'error': None}
+    try:
+        # Not from the pool, resizing the input changes the interpreter for good.
+        interpreter = tflite_runtime.interpreter.Interpreter(model_path)
+        index = interpreter.get_input_details()[0]['index']
+        shape = list(interpreter.get_input_details()[0]['shape'])
+        interpreter.resize_tensor_input(index, [batch_size] + shape[1:])
+        interpreter.allocate_tensors()
+    except Exception as e:
+        row['error'] = f'Model can not be batched, reason: {e}'
+        return row
+    # Graphs with the batch size baked into a reshape allocate fine but don't produce a result per frame.
+    if any(details['shape'][0] != batch_size for details in interpreter.get_output_details()):
+        row['error'] = 'Model can not be batched, reason: its outputs keep a batch size of 1'
+        return row
+
+    plan = PreprocessPlan(interpreter)
+    source = open_source(input_path, loop=True)
+    timings = StageTimings(window=num_frames)
+    busy = 0.0
+    try:
+        for i in range(0, warmup + num_frames, batch_size):
+            frames = [frame for frame in (source.read() for _ in range(batch_size)) if frame is not None]
+            if len(frames) < batch_size:
+                break
+            t0 = perf_counter()
+            for slot, frame in enumerate(frames):
+                cv2.resize(frame.image, (plan.width, plan.height), dst=plan.resized, interpolation=plan.interpolation)
+                plan.convert(plan.resized, plan.input_tensor()[slot])
+            t1 = perf_counter()
+            interpreter.invoke()
+            t2 = perf_counter()
+            if i >= warmup:
+                for _ in frames:
+                    timings.record('preprocess', (t1 - t0) / batch_size)
+                    timings.record('invoke', (t2 - t1) / batch_size)
+                busy += t2 - t0
+                row['frames'] += batch_size
+    except Exception as e:
+        row['error'] = f'Failed to process frame {i}, reason: {type(e).__name__}: {e}'
+        return row
+    finally:
+        source.release()
+
+    if row['frames'] == 0:
+        row['error'] = f'No frames could be read from {input_path}'
+        return row
+    summary = timings.summary()
+    row['fps'] = row['frames'] / busy if busy > 0 else 0.0
+    row['stages'] = {stage: {key: summary[stage][key] for key in ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms')}
+                     for stage in STAGES if stage in summary}
+    return row
+
+
+def write_json(rows: list, out):
+    """ Writes the report as JSON along with a description of the host.
+    :param rows: The rows returned by benchmark_model().
+    :param out: The file to write to.
+    :return: None
+    """
+    report = {'timestamp': time(), 'host': platform.node(), 'machine': platform.machine(),
+              'python': platform.python_version(), 'results': rows}
+    json.dump(report, out, indent=2)
+    out.write('\n')
+
+
+def write_csv(rows: list, out):
+    """ Writes the report as CSV, one row per (model, edgetpu) with a column per stage percentile and cold start
+    phase.
+    :param rows: The rows returned by benchmark_model().
+    :param out: The file to write to.
+    :return: None
+    """
+    header = ['model', 'inference_type', 'edgetpu', 'batch', 'frames', 'fps']
+    header += [f'{stage}_{p}_ms' for stage in STAGES for p in ('p50', 'p95', 'p99')]
+    header += [f'cold_{phase}_ms' for phase in COLD_START_PHASES]
+    header.append('error')
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for row in rows:
+        line = [row['model'], row['inference_type'], row['edgetpu'], row['batch'], row['frames'],
+                f'{row["fps"]:.2f}']
+        for stage in STAGES:
+            stats = row['stages'].get(stage, {})
+            line += [f'{stats.get(f"{p}_ms", 0.0):.3f}' for p in ('p50', 'p95', 'p99')]
+        cold_start = row['cold_start'] or {}
+        line += ['' if cold_start.get(f'{phase}_ms') is None else f'{cold_start[f"{phase}_ms"]:.3f}'
+                 for phase in COLD_START_PHASES]
+        line.append(row['error'] or '')
+        writer.writerow(line)
+
+
+def parse_args():
+    """ Parses the command line arguments.
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark Coral Cam models offline, without a camera or browser.')
+    parser.add_argument('input', help='A directory of images or a video file.')
+    parser.add_argument('--models', nargs='*', default=None,
+                        help='Names of the models to benchmark (default: every model found in test_data).')
+    parser.add_argument('--inference-type', choices=list(ModelUtils.inference_type_to_model_names), default=None,
+                        help='Only benchmark the models of this inference type.')
+    parser.add_argument('--device', choices=['both', 'edgetpu', 'cpu'], default='both',
+                        help='Whether to run the edgetpu variant, the cpu variant or both (default: both).')
+    parser.add_argument('--frames', type=int, default=100, help='Number of timed frames per model.')
+    parser.add_argument('--warmup', type=int, default=5, help='Number of untimed frames per model.')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Invoke cpu models on batches of this many frames, for models that allow it.')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json', help='Report format.')
+    parser.add_argument('--output', default=None, help='Where to write the report (default: stdout).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model_names = args.models or list(ModelUtils.available_models())
+    if args.inference_type:
+        model_names = [name for name in model_names
+                       if name in ModelUtils.inference_type_to_model_names[args.inference_type]]
+    devices = {'both': [True, False], 'edgetpu': [True], 'cpu': [False]}[args.device]
+
+    # Only keep one interpreter around at a time, models are run one after another.
+    pool = InterpreterPool(max_entries=1)
+    rows = []
+    for model_name in model_names:
+        for edgetpu in devices:
+            if args.batch > 1 and not edgetpu:
+                row = benchmark_batched(model_name, args.input, args.frames, args.warmup, args.batch)
+            else:
+                row = benchmark_model(pool, model_name, edgetpu, args.input, args.frames, args.warmup)
+            status = row['error'] or f'{row["fps"]:.2f} fps'
+            print(f'{model_name} ({"edgetpu" if edgetpu else "cpu"}): {status}', file=sys.stderr)
+            rows.append(row)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            write_json(rows, out)
+        else:
+            write_csv(rows, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
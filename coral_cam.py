@@ -1,18 +1,28 @@
 import os
+import queue
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import numpy as np
 import cv2
 import eel
-from time import time
+from functools import lru_cache
+from time import perf_counter, time
+from typing import NamedTuple
 
 import tflite_runtime.interpreter
-from PIL import Image
-from tflite_runtime.interpreter import Interpreter
-from tflite_runtime.interpreter import load_delegate
+from cpu_workers import ProcessPoolRunner
+from encoder import JpegEncoder
+from engine_pool import ColdStart, InterpreterPool
+from metrics import Metrics, StageTimings
 from model_utils import ModelUtils
-
-EDGETPU_SHARED_LIB = 'libedgetpu.so.1'
-POSENET_SHARED_LIB = os.path.join(
-    'posenet_lib', os.uname().machine, 'posenet_decoder.so')
+from pipeline import Pipeline
+from preprocess import PreprocessPlan
+from results import ClassificationResult, DetectionResult, PoseResult, SegmentationResult
+from scheduler import InferenceScheduler
+from sources import open_source
+from temporal import TemporalReuse
 
 
 class InferenceAdaptor:
@@ -21,15 +31,30 @@ class InferenceAdaptor:
     classification, pose estimation, and segmentation on an image.
     """
     coral_bgr = (77, 94, 253)  # The coral color in (B, G, R).
+    _scratch = threading.local()  # Per thread buffers reused across frames by the draw stage.
+    _detection_outputs = weakref.WeakKeyDictionary()  # PreprocessPlan -> (boxes, classes, scores) output indices.
+    # Tunables of the decode and draw stages, set_engine() overrides them per engine.
+    default_options = {
+        'score_threshold': 0.5,  # Detections scoring at or below this are dropped.
+        'max_detections': None,  # Keep at most this many detections, the highest scoring first. None keeps all.
+        'segmentation_alpha': None,  # Opacity of the segmentation mask over the camera image, None replaces it.
+        'pose_score_threshold': 0.2,  # Poses scoring at or below this are dropped.
+        'keypoint_score_threshold': 0.5,  # Keypoints scoring at or below this are not drawn.
+    }
+    # Pairs of keypoints joined by the skeleton, in the 17 keypoint COCO order both PoseNet and MoveNet use.
+    skeleton_edges = np.array([(0, 1), (0, 2), (1, 3), (2, 4), (5, 6), (5, 7), (7, 9), (6, 8), (8, 10), (5, 11),
+                               (6, 12), (11, 12), (11, 13), (13, 15), (12, 14), (14, 16)], dtype=np.int32)
 
     @staticmethod
     def add_model_info(interpreter: tflite_runtime.interpreter.Interpreter, model_path: str, latency: str,
-                       image: cv2.cvtColor):
+                       image: cv2.cvtColor, plan: PreprocessPlan = None, input_size: tuple = None):
         """ Writes the model info on the top left corner of an image.
-        :param interpreter: The tflite interpreter.
+        :param interpreter: The tflite interpreter, may be None if plan or input_size is given.
         :param model_path: The path to the model.
         :param latency: The latency string to put on the image.
         :param image: The image to put the latency string on.
+        :param plan: The preprocessing plan of the interpreter, to avoid querying its input details.
+        :param input_size: The (width, height) of the model input, e.g. when replaying recorded results.
         :return: None
         """
         latency_size, _ = cv2.getTextSize(latency, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
@@ -41,9 +66,14 @@ class InferenceAdaptor:
         cv2.putText(image, model_name, (10, model_name_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
                     InferenceAdaptor.coral_bgr, 1)
 
-        input_details = interpreter.get_input_details()
-        width = input_details[0]['shape'][2]
-        height = input_details[0]['shape'][1]
+        if input_size is not None:
+            width, height = input_size
+        elif plan is None:
+            input_details = interpreter.get_input_details()
+            width = input_details[0]['shape'][2]
+            height = input_details[0]['shape'][1]
+        else:
+            width, height = plan.width, plan.height
         size_str = f'size: {width}x{height}'
         model_size, _ = cv2.getTextSize(size_str, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
         model_size_y = model_name_y + model_size[1] + 5
@@ -51,239 +81,1287 @@ class InferenceAdaptor:
                     InferenceAdaptor.coral_bgr, 1)
 
     @staticmethod
-    def run_inference(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor):
+    def run_inference(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor,
+                      plan: PreprocessPlan = None):
         """ Transform image input into input tensors for the interpreter and then call invoke.
         :param interpreter: The tflite interpreter.
         :param image: The image.
-        :return: None
+        :param plan: The preprocessing plan of the interpreter, one is built on the fly if None.
+        :return: The model input width, height and the latency string.
         """
-        input_details = interpreter.get_input_details()
-        width = input_details[0]['shape'][2]
-        height = input_details[0]['shape'][1]
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        resized = cv2.resize(rgb, (width, height))
-        if interpreter.get_input_details()[0]['dtype'] == np.float32:
-            input_data = np.float32(resized) / 128.0 - 1.0
-        else:
-            input_data = np.asarray(resized)
-        input_data = np.expand_dims(input_data, axis=0)
+        if plan is None:
+            plan = PreprocessPlan(interpreter)
+        # Resize and convert straight into the input buffer, no set_tensor() copy needed.
+        plan.fill(image)
 
-        # Set input and run inference.
+        # Run inference.
         t0 = time()
-        interpreter.set_tensor(input_details[0]['index'], input_data)
         interpreter.invoke()
         latency = 'latency: {:.2f} ms'.format((time() - t0) * 1000)
-        return width, height, latency
+        return plan.width, plan.height, latency
 
     @staticmethod
-    def classify(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str):
-        """ Run the classification on the image and then writes labels on the image.
-        :param interpreter: The tflite interpreter.
-        :param image: The image to run classification on.
+    def decode_classification(interpreter: tflite_runtime.interpreter.Interpreter, plan: PreprocessPlan,
+                              model_name: str, image_shape: tuple, options: dict = None):
+        """ Reads the top-1 class out of a classification model.
+        :param interpreter: The tflite interpreter, already invoked.
+        :param plan: The preprocessing plan of the interpreter.
         :param model_name: The path to the model.
-        :return: The processed image.
+        :param image_shape: The shape of the image that was fed to the model.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The ClassificationResult.
         """
-        # Run Inference on image.
-        _, _, latency = InferenceAdaptor.run_inference(interpreter, image)
-
-        # Get output. 
         output_details = interpreter.get_output_details()[0]
         output = np.squeeze(interpreter.get_tensor(output_details['index']))
         # If the model is quantized (uint8 data), then dequantize the results
         if output_details['dtype'] == np.uint8:
             scale, zero_point = output_details['quantization']
             output = scale * (output - zero_point)
-        max_idx = np.argmax(output)
-        score = output[max_idx]
-        class_label = f'class: {ModelUtils.get_classification_class(max_idx)}'
+        max_idx = int(np.argmax(output))
+        return ClassificationResult(max_idx, ModelUtils.get_classification_class(max_idx), float(output[max_idx]))
+
+    @staticmethod
+    def draw_classification(image: cv2.cvtColor, result: ClassificationResult):
+        """ Writes the class and score on the top right corner of an image.
+        :param image: The image to draw on.
+        :param result: The ClassificationResult.
+        :return: The image.
+        """
+        class_label = f'class: {result.label}'
         label_size, _ = cv2.getTextSize(class_label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)
-        label_x_location = 1280 - ((label_size[0]) + 30)
+        label_x_location = image.shape[1] - ((label_size[0]) + 30)
         label_y_location = label_size[1] + 5
         cv2.putText(image, class_label, (label_x_location, label_y_location), cv2.FONT_HERSHEY_SIMPLEX, 0.7,
                     InferenceAdaptor.coral_bgr, 2)
-        score_label = f'score: {score}'
+        score_label = f'score: {result.score}'
         score_size, _ = cv2.getTextSize(score_label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)
         score_x_location = label_x_location
         score_y_location = label_y_location + score_size[1] + 5
         cv2.putText(image, score_label, (score_x_location, score_y_location), cv2.FONT_HERSHEY_SIMPLEX, 0.7,
                     InferenceAdaptor.coral_bgr, 2)
-        InferenceAdaptor.add_model_info(interpreter, model_name, latency, image)
         return image
 
     @staticmethod
-    def detect(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str):
-        """ Run detection on the image and then writes labels on the image.
+    def decode_detection(interpreter: tflite_runtime.interpreter.Interpreter, plan: PreprocessPlan,
+                         model_name: str, image_shape: tuple, options: dict = None):
+        """ Reads the detections out of a detection model and scales them to the image.
+        :param interpreter: The tflite interpreter, already invoked.
+        :param plan: The preprocessing plan of the interpreter.
+        :param model_name: The path to the model.
+        :param image_shape: The shape of the image that was fed to the model.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The DetectionResult.
+        """
+        options = options or InferenceAdaptor.default_options
+        image_height, image_width = image_shape[0], image_shape[1]
+        boxes_index, classes_index, scores_index = InferenceAdaptor.detection_outputs(interpreter, plan)
+        boxes = interpreter.get_tensor(boxes_index)[0]
+        classes = interpreter.get_tensor(classes_index)[0]
+        scores = interpreter.get_tensor(scores_index)[0]
+
+        keep = np.flatnonzero((scores > options['score_threshold']) & (scores < 1.0))
+        max_detections = options['max_detections']
+        if max_detections is not None and len(keep) > max_detections:
+            keep = keep[np.argsort(-scores[keep], kind='stable')[:max_detections]]
+        # Boxes are normalized (y_min, x_min, y_max, x_max), scale them to the image and reorder to
+        # (x_min, y_min, x_max, y_max). The interpreter can return coordinates that are outside of the image, clip them.
+        scaled = boxes[keep][:, [1, 0, 3, 2]] * np.array([image_width, image_height, image_width, image_height],
+                                                         dtype=np.float32)
+        np.clip(scaled, 1, [image_width, image_height, image_width, image_height], out=scaled)
+        kept_classes = classes[keep].astype(np.int32)
+        labels = [ModelUtils.get_detection_class(class_id) for class_id in kept_classes.tolist()]
+        return DetectionResult(scaled.astype(np.int32), kept_classes, scores[keep].astype(np.float32), labels)
+
+    @staticmethod
+    def detection_outputs(interpreter: tflite_runtime.interpreter.Interpreter, plan: PreprocessPlan):
+        """ Works out which outputs of a detection model hold the boxes, classes and scores, once per engine. Models
+        exported from TF1 list them as (boxes, classes, scores, count), TF2 exports such as EfficientDet-Lite in
+        another order.
         :param interpreter: The tflite interpreter.
-        :param image: The image to run detection on.
+        :param plan: The preprocessing plan of the interpreter.
+        :return: The (boxes, classes, scores) output tensor indices.
+        """
+        outputs = InferenceAdaptor._detection_outputs.get(plan)
+        if outputs is not None:
+            return outputs
+        details = {detail['index']: detail for detail in interpreter.get_output_details()}
+        indices = plan.output_indices
+        if len(indices) < 3:
+            raise ValueError(f'Detection models have 4 outputs, this one has {len(indices)}')
+        # The boxes are the only (1, N, 4) output and the count the only single value one.
+        boxes = next((i for i in indices if len(details[i]['shape']) == 3 and details[i]['shape'][-1] == 4),
+                     indices[0])
+        rest = [i for i in indices if i != boxes and len(details[i]['shape']) == 2]
+        # Classes and scores have the same shape, tell them apart by name when the model names them.
+        signatures = interpreter._get_full_signature_list() if hasattr(interpreter, '_get_full_signature_list') \
+            else None
+        signature_outputs = next(iter(signatures.values()))['outputs'] if signatures and len(signatures) == 1 else {}
+        names = {index: name.lower() for name, index in signature_outputs.items()}
+        named = {role: [i for i in rest if role in names.get(i, details[i]['name'].lower())]
+                 for role in ('class', 'score')}
+        if len(named['class']) == 1 and len(named['score']) == 1:
+            classes, scores = named['class'][0], named['score'][0]
+        elif {'output_1', 'output_2'} <= signature_outputs.keys():
+            # TF2 signatures number their outputs (count, scores, classes, boxes), see pycoral's get_objects().
+            classes, scores = signature_outputs['output_2'], signature_outputs['output_1']
+        elif indices.index(boxes) < indices.index(rest[0]):
+            classes, scores = rest[:2]
+        else:
+            scores, classes = rest[:2]
+        outputs = InferenceAdaptor._detection_outputs[plan] = (boxes, classes, scores)
+        return outputs
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def text_size(text: str, scale: float, thickness: int):
+        """ Cached cv2.getTextSize() with the font used by every label.
+        :param text: The text.
+        :param scale: The font scale.
+        :param thickness: The font thickness.
+        :return: ((width, height), baseline)
+        """
+        return cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+
+    @staticmethod
+    def label_size(name: str, suffix: str, scale: float, thickness: int):
+        """ Get the size of name + suffix from the cached sizes of both parts, so the cache holds an entry per class
+        name and one per score rather than one per combination of the two.
+        :param name: The class name.
+        :param suffix: The text following it, e.g. ': 87%'.
+        :param scale: The font scale.
+        :param thickness: The font thickness.
+        :return: ((width, height), baseline), the same as text_size() of the whole label.
+        """
+        (name_width, name_height), baseline = InferenceAdaptor.text_size(name, scale, thickness)
+        (suffix_width, suffix_height), _ = InferenceAdaptor.text_size(suffix, scale, thickness)
+        # The glyph advances add up, but both widths include the thickness once.
+        return (name_width + suffix_width - thickness, max(name_height, suffix_height)), baseline
+
+    @staticmethod
+    def draw_detection(image: cv2.cvtColor, result: DetectionResult):
+        """ Draws the boxes and labels of the detections on an image.
+        :param image: The image to draw on.
+        :param result: The DetectionResult.
+        :return: The image.
+        """
+        if len(result.boxes) == 0:
+            return image
+        x_min, y_min, x_max, y_max = result.boxes.T
+        # All boxes in one polylines call rather than a rectangle call per box.
+        corners = np.stack([np.stack([x_min, y_min], -1), np.stack([x_max, y_min], -1),
+                            np.stack([x_max, y_max], -1), np.stack([x_min, y_max], -1)], axis=1)
+        cv2.polylines(image, corners, True, InferenceAdaptor.coral_bgr, 4)
+
+        suffixes = [': %d%%' % int(score * 100) for score in result.scores.tolist()]
+        labels = [name + suffix for name, suffix in zip(result.labels, suffixes)]
+        sizes = [InferenceAdaptor.label_size(name, suffix, 0.7, 2) for name, suffix in zip(result.labels, suffixes)]
+        label_width = np.array([size[0][0] for size in sizes], dtype=np.int32)
+        label_height = np.array([size[0][1] for size in sizes], dtype=np.int32)
+        base_line = np.array([size[1] for size in sizes], dtype=np.int32)
+        # Make sure not to draw label too close to top of window.
+        label_y = np.maximum(y_min, label_height + 10)
+        top, bottom = label_y - label_height - 10, label_y + base_line - 10
+        backgrounds = np.stack([np.stack([x_min, top], -1), np.stack([x_min + label_width, top], -1),
+                                np.stack([x_min + label_width, bottom], -1), np.stack([x_min, bottom], -1)], axis=1)
+        cv2.fillPoly(image, backgrounds, InferenceAdaptor.coral_bgr)
+        for label, x, y in zip(labels, x_min.tolist(), (label_y - 7).tolist()):
+            cv2.putText(image, label, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        return image
+
+    @staticmethod
+    def decode_pose(interpreter: tflite_runtime.interpreter.Interpreter, plan: PreprocessPlan,
+                    model_name: str, image_shape: tuple, options: dict = None):
+        """ Reads the poses out of a PoseNet or MoveNet model, drops the low scoring ones and scales the rest to the
+        image.
+        :param interpreter: The tflite interpreter, already invoked.
+        :param plan: The preprocessing plan of the interpreter.
         :param model_name: The path to the model.
-        :return: The processed image.
+        :param image_shape: The shape of the image that was fed to the model.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The PoseResult.
+        """
+        options = options or InferenceAdaptor.default_options
+        image_height, image_width = image_shape[0], image_shape[1]
+        outputs = plan.output_indices
+        if 'posenet' in os.path.basename(model_name):
+            # The PoseNet decoder outputs keypoints as (y, x) in model input pixels, keypoint scores, pose scores and
+            # the number of poses found, padded to the maximum number of poses.
+            num_poses = int(interpreter.get_tensor(outputs[3]).flat[0])
+            keypoints = interpreter.get_tensor(outputs[0])[0, :num_poses]
+            keypoint_scores = interpreter.get_tensor(outputs[1])[0, :num_poses]
+            pose_scores = interpreter.get_tensor(outputs[2])[0, :num_poses]
+            scale = np.array([image_width / plan.width, image_height / plan.height], dtype=np.float32)
+        else:
+            # MoveNet keypoints are (y, x, score) normalized to [0, 1]. It always finds one pose, score it by its
+            # keypoints so frames without anyone in them can be dropped too.
+            output = interpreter.get_tensor(outputs[0]).reshape(1, -1, 3)
+            keypoints, keypoint_scores = output[..., :2], output[..., 2]
+            pose_scores = keypoint_scores.mean(axis=1)
+            scale = np.array([image_width, image_height], dtype=np.float32)
+        keep = np.flatnonzero(pose_scores > options['pose_score_threshold'])
+        # Swap (y, x) to (x, y) and scale to the image in one go.
+        scaled = keypoints[keep][..., ::-1] * scale
+        return PoseResult(scaled.astype(np.float32), keypoint_scores[keep].astype(np.float32),
+                          pose_scores[keep].astype(np.float32))
+
+    @staticmethod
+    def draw_pose(image: cv2.cvtColor, result: PoseResult, keypoint_threshold: float = 0.5):
+        """ Draws the skeleton and keypoints of every pose on an image.
+        :param image: The image to draw on.
+        :param result: The PoseResult.
+        :param keypoint_threshold: Keypoints scoring at or below this are not drawn, nor are the edges they end.
+        :return: The image.
+        """
+        if len(result.keypoints) == 0:
+            return image
+        points = np.rint(result.keypoints).astype(np.int32)
+        if result.keypoint_scores is None:
+            visible = np.ones(points.shape[:2], dtype=bool)
+        else:
+            visible = (result.keypoint_scores > keypoint_threshold) & (result.keypoint_scores < 1.0)
+        if points.shape[1] == 17:
+            # Every edge of every pose in one polylines call, as (num_edges, 2, 2) segments.
+            starts, ends = InferenceAdaptor.skeleton_edges.T
+            segments = np.stack([points[:, starts], points[:, ends]], axis=2)
+            segments = segments[visible[:, starts] & visible[:, ends]]
+            if len(segments):
+                cv2.polylines(image, segments, False, InferenceAdaptor.coral_bgr, 2, cv2.LINE_AA)
+        # A thick zero length segment draws a filled dot, all keypoints in one call rather than a circle call each.
+        dots = np.repeat(points[visible][:, np.newaxis], 2, axis=1)
+        if len(dots):
+            cv2.polylines(image, dots, False, InferenceAdaptor.coral_bgr, 12)
+        return image
+
+    @staticmethod
+    def decode_segmentation(interpreter: tflite_runtime.interpreter.Interpreter, plan: PreprocessPlan,
+                            model_name: str, image_shape: tuple, options: dict = None):
+        """ Reads the label mask out of a segmentation model.
+        :param interpreter: The tflite interpreter, already invoked.
+        :param plan: The preprocessing plan of the interpreter.
+        :param model_name: The path to the model.
+        :param image_shape: The shape of the image that was fed to the model.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The SegmentationResult.
+        """
+        output_details = interpreter.get_output_details()[0]
+        output = interpreter.tensor(output_details['index'])()[0]
+        if len(output.shape) == 3:
+            output = np.argmax(output, axis=-1)
+        # Copy out of the interpreter's buffer, the mask has to survive the next invoke.
+        return SegmentationResult(output.astype(np.uint8))
+
+    @staticmethod
+    def _scratch_buffer(name: str, shape: tuple):
+        """ Get a per thread buffer that is reused across frames as long as its shape doesn't change.
+        :param name: The name of the buffer.
+        :param shape: The shape of the buffer, its dtype is uint8.
+        :return: The buffer, its content is undefined.
         """
-        # Run Inference on image.
-        _, _, latency = InferenceAdaptor.run_inference(interpreter, image)
+        buffers = InferenceAdaptor._scratch.__dict__
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffer
 
-        # Get output tensor
+    @staticmethod
+    def draw_segmentation(image: cv2.cvtColor, result: SegmentationResult, alpha: float = None):
+        """ Colorizes the segmentation mask and either replaces the image with it or blends it over the image.
+        :param image: The image the mask belongs to, it is drawn on in place.
+        :param result: The SegmentationResult.
+        :param alpha: The opacity of the mask in (0, 1) to blend it over the image, None or 1 replaces the image.
+        :return: The image.
+        """
         image_height, image_width = image.shape[0], image.shape[1]
-        output_details = interpreter.get_output_details()
-        boxes = interpreter.get_tensor(output_details[0]['index'])[0]
-        classes = interpreter.get_tensor(output_details[1]['index'])[0]
-        scores = interpreter.get_tensor(output_details[2]['index'])[0]
-
-        for i in range(len(scores)):
-            if 0.5 < scores[i] < 1.0:
-                # Interpreter can return coordinates that are outside of image dimensions, need to force them to be
-                # within image using max() and min()
-                y_min = int(max(1, (boxes[i][0] * image_height)))
-                x_min = int(max(1, (boxes[i][1] * image_width)))
-                y_max = int(min(image_height, (boxes[i][2] * image_height)))
-                x_max = int(min(image_width, (boxes[i][3] * image_width)))
-                cv2.rectangle(image, (x_min, y_min), (x_max, y_max), InferenceAdaptor.coral_bgr, 4)
-                label = '%s: %d%%' % (ModelUtils.get_detection_class(int(classes[i])), int(scores[i] * 100))
-                label_size, base_line = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)
-                # Make sure not to draw label too close to top of window.
-                label_y = max(y_min, label_size[1] + 10)
-                cv2.rectangle(image, (x_min, label_y - label_size[1] - 10), (
-                    x_min + label_size[0], label_y + base_line - 10), InferenceAdaptor.coral_bgr, cv2.FILLED)
-                cv2.putText(image, label, (x_min, label_y - 7),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-        InferenceAdaptor.add_model_info(interpreter, model_name, latency, image)
+        # Colorize at model resolution with the BGR uint8 lookup table, then upscale once.
+        colored = InferenceAdaptor._scratch_buffer('segmentation_colored', result.mask.shape + (3,))
+        np.take(ModelUtils.segmentation_bgr_lut(), result.mask, axis=0, out=colored)
+        if alpha is None or alpha >= 1.0:
+            cv2.resize(colored, (image_width, image_height), dst=image)
+            return image
+        overlay = InferenceAdaptor._scratch_buffer('segmentation_overlay', image.shape)
+        cv2.resize(colored, (image_width, image_height), dst=overlay)
+        cv2.addWeighted(image, 1.0 - alpha, overlay, alpha, 0.0, dst=image)
         return image
 
     @staticmethod
-    def pose_estimate(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str):
+    def stages(inference_type: str):
+        """ Get the decode and draw functions of an inference type.
+        :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        :return: A (decode, draw) tuple.
+        """
+        if inference_type == 'classification':
+            return InferenceAdaptor.decode_classification, InferenceAdaptor.draw_classification
+        elif inference_type == 'detection':
+            return InferenceAdaptor.decode_detection, InferenceAdaptor.draw_detection
+        elif inference_type == 'pose-estimation':
+            return InferenceAdaptor.decode_pose, InferenceAdaptor.draw_pose
+        else:
+            return InferenceAdaptor.decode_segmentation, InferenceAdaptor.draw_segmentation
+
+    @staticmethod
+    def draw_result(inference_type: str, image: cv2.cvtColor, result, options: dict):
+        """ Draws a decoded result on an image with the draw function of its inference type.
+        :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        :param image: The image, it is drawn on in place where possible.
+        :param result: The decoded result.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The image.
+        """
+        _, draw = InferenceAdaptor.stages(inference_type)
+        if inference_type == 'segmentation':
+            return draw(image, result, options['segmentation_alpha'])
+        if inference_type == 'pose-estimation':
+            return draw(image, result, options['keypoint_score_threshold'])
+        return draw(image, result)
+
+    @staticmethod
+    def draw(engine, image: cv2.cvtColor, result, latency: float, input_size: tuple = None):
+        """ Draws a decoded result and the model info on an image.
+        :param engine: The Engine that produced the result.
+        :param image: The image, it is drawn on in place where possible.
+        :param result: The decoded result.
+        :param latency: The invoke duration in seconds.
+        :param input_size: The (width, height) of the model input, for engines without an interpreter or plan.
+        :return: The image.
+        """
+        image = InferenceAdaptor.draw_result(engine.inference_type, image, result, engine.options)
+        InferenceAdaptor.add_model_info(engine.interpreter, engine.model_path, f'latency: {latency * 1000:.2f} ms',
+                                        image, engine.plan, input_size)
+        return image
+
+    @staticmethod
+    def infer(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, inference_type: str,
+              model_name: str, plan: PreprocessPlan = None, timings: StageTimings = None, options: dict = None):
+        """ Runs the stages up to a decoded result on an image: preprocess, invoke and postprocess (decode).
+        :param interpreter: The tflite interpreter.
+        :param image: The image.
+        :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        :param model_name: The path to the model.
+        :param plan: The preprocessing plan of the interpreter, one is built on the fly if None.
+        :param timings: Where to record the duration of each stage, nothing is recorded if None.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The decoded result and the invoke duration in seconds.
+        """
+        if plan is None:
+            plan = PreprocessPlan(interpreter)
+        decode, _ = InferenceAdaptor.stages(inference_type)
+        t0 = perf_counter()
+        plan.fill(image)
+        t1 = perf_counter()
+        interpreter.invoke()
+        t2 = perf_counter()
+        result = decode(interpreter, plan, model_name, image.shape, options)
+        t3 = perf_counter()
+        if timings is not None:
+            timings.record('preprocess', t1 - t0)
+            timings.record('invoke', t2 - t1)
+            timings.record('postprocess', t3 - t2)
+        return result, t2 - t1
+
+    @staticmethod
+    def process(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, inference_type: str,
+                model_name: str, plan: PreprocessPlan = None, timings: StageTimings = None, options: dict = None):
+        """ Runs every stage on an image: preprocess, invoke, postprocess (decode) and annotate (draw).
+        :param interpreter: The tflite interpreter.
+        :param image: The image.
+        :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        :param model_name: The path to the model.
+        :param plan: The preprocessing plan of the interpreter, one is built on the fly if None.
+        :param timings: Where to record the duration of each stage, nothing is recorded if None.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The processed image and the decoded result.
+        """
+        if plan is None:
+            plan = PreprocessPlan(interpreter)
+        result, latency = InferenceAdaptor.infer(interpreter, image, inference_type, model_name, plan, timings, options)
+        t0 = perf_counter()
+        image = InferenceAdaptor.draw(Engine(interpreter, inference_type, model_name, plan,
+                                             options or InferenceAdaptor.default_options), image, result, latency)
+        if timings is not None:
+            timings.record('annotate', perf_counter() - t0)
+        return image, result
+
+    @staticmethod
+    def classify(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str,
+                 plan: PreprocessPlan = None):
+        """ Run the classification on the image and then writes labels on the image.
+        :param interpreter: The tflite interpreter.
+        :param image: The image to run classification on.
+        :param model_name: The path to the model.
+        :param plan: The preprocessing plan of the interpreter.
+        :return: The processed image.
+        """
+        return InferenceAdaptor.process(interpreter, image, 'classification', model_name, plan)[0]
+
+    @staticmethod
+    def detect(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str,
+               plan: PreprocessPlan = None):
         """ Run detection on the image and then writes labels on the image.
+        :param interpreter: The tflite interpreter.
+        :param image: The image to run detection on.
+        :param model_name: The path to the model.
+        :param plan: The preprocessing plan of the interpreter.
+        :return: The processed image.
+        """
+        return InferenceAdaptor.process(interpreter, image, 'detection', model_name, plan)[0]
+
+    @staticmethod
+    def pose_estimate(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str,
+                      plan: PreprocessPlan = None):
+        """ Run pose estimation on the image and then draws the keypoints on the image.
        :param interpreter: The tflite interpreter.
        :param image: The image to run pose estimation on.
        :param model_name: The name of the model.
+       :param plan: The preprocessing plan of the interpreter.
        :return: The processed image.
        """
-        # Run Inference on image.
-        model_width, model_height, latency = InferenceAdaptor.run_inference(interpreter, image)
-
-        def get_output_tensor(interpreter_, idx):
-            return np.squeeze(interpreter_.tensor(interpreter.get_output_details()[idx]['index'])())
-
-        image_height, image_width = image.shape[0], image.shape[1]
-        if 'posenet' in model_name:
-            keypoints = get_output_tensor(interpreter, 0)
-            # keypoints_scores = get_output_tensor(interpreter, 1)
-            # pose_scores = get_output_tensor(interpreter, 2)
-            num_poses = get_output_tensor(interpreter, 3)
-
-            for i in range(int(num_poses)):
-                for keypoint in keypoints[i]:
-                    y, x = keypoint
-                    x, y = int((x / model_width) * image_width), int((y / model_height) * image_height)
-                    image = cv2.circle(image, (x, y), radius=3, color=InferenceAdaptor.coral_bgr, thickness=5)
-        else:
-            keypoints = get_output_tensor(interpreter, 0)
-            for keypoint in keypoints:
-                y, x, score = keypoint
-                if 0.5 < score < 1.0:
-                    x, y = int(x * image_width), int(y * image_height)
-                    image = cv2.circle(image, (x, y), radius=3, color=InferenceAdaptor.coral_bgr, thickness=5)
-        InferenceAdaptor.add_model_info(interpreter, model_name, latency, image)
-        return image
+        return InferenceAdaptor.process(interpreter, image, 'pose-estimation', model_name, plan)[0]
 
     @staticmethod
-    def segmentation(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str):
-        """ Run detection on the image and then writes labels on the image.
+    def segmentation(interpreter: tflite_runtime.interpreter.Interpreter, image: cv2.cvtColor, model_name: str,
+                     plan: PreprocessPlan = None):
+        """ Run segmentation on the image and then replaces the image with the colorized mask.
         :param interpreter: The tflite interpreter.
         :param image: The image to run segmentation on.
         :param model_name: The path to the model.
+        :param plan: The preprocessing plan of the interpreter.
         :return: The processed image.
         """
-        # Run Inference on image.
-        _, _, latency = InferenceAdaptor.run_inference(interpreter, image)
+        return InferenceAdaptor.process(interpreter, image, 'segmentation', model_name, plan)[0]
 
-        # Get output.
-        image_height, image_width = image.shape[0], image.shape[1]
-        output_details = interpreter.get_output_details()[0]
-        output = interpreter.tensor(output_details['index'])()[0].astype(np.uint8)
-        if len(output.shape) == 3:
-            output = np.argmax(output, axis=-1)
-        mask_img = Image.fromarray(ModelUtils.label_to_color_image(output).astype(np.uint8))
-        image = cv2.resize(cv2.cvtColor(np.array(mask_img), cv2.COLOR_RGB2BGR), dsize=(image_width, image_height))
-        InferenceAdaptor.add_model_info(interpreter, model_name, latency, image)
+
+class Engine(NamedTuple):
+    """
+    Everything needed to process a frame with a model. A stream swaps the whole bundle at once, so a frame is never
+    processed with the interpreter of one model and the inference type or options of another.
+    """
+    interpreter: tflite_runtime.interpreter.Interpreter
+    inference_type: str  # [classification, detection, pose-estimation, segmentation]
+    model_path: str
+    plan: PreprocessPlan
+    options: dict  # Decode/draw tunables, see InferenceAdaptor.default_options.
+
+
+class MultiModelRunner:
+    """
+    Runs every frame through several engines at once, e.g. a classifier and a detector, or two detectors to compare.
+    Frames are resized once per distinct model input size and the interpreters are invoked on a thread pool, tflite
+    releases the GIL while invoking so the models run on separate cores. The results are either drawn on separate
+    copies of the frame laid out side by side, or all composited on the frame itself.
+    """
+    layouts = ('side-by-side', 'composite')
+
+    def __init__(self, engines: list, layout: str = 'side-by-side', max_workers: int = None):
+        """
+        :param engines: The Engines to run, each with its own interpreter.
+        :param layout: One of MultiModelRunner.layouts.
+        :param max_workers: The number of models invoked concurrently, one per model up to the number of cores if None.
+        """
+        if layout not in MultiModelRunner.layouts:
+            raise ValueError(f'Unknown layout {layout}, expected one of {", ".join(MultiModelRunner.layouts)}')
+        if len({id(engine.interpreter) for engine in engines}) != len(engines):
+            raise ValueError('Every model must have its own interpreter, they are invoked concurrently')
+        self.engines = tuple(engines)
+        self.layout = layout
+        self.inference_type = 'multi-model'
+        self.model_path = ', '.join(engine.model_path for engine in engines)
+        # (width, height) -> reused resize buffer, shared by every model with that input size.
+        self.resized = {(engine.plan.width, engine.plan.height): np.empty((engine.plan.height, engine.plan.width, 3),
+                                                                          dtype=np.uint8)
+                        for engine in engines}
+        self.executor = ThreadPoolExecutor(max_workers or min(len(engines), os.cpu_count() or 1),
+                                           thread_name_prefix='coral-cam-model')
+        self.tiles = [None] * len(engines)  # Reused per model copies of the frame for the side by side layout.
+
+    @staticmethod
+    def _invoke(interpreter: tflite_runtime.interpreter.Interpreter):
+        t0 = perf_counter()
+        interpreter.invoke()
+        return perf_counter() - t0
+
+    def process(self, image, timings: StageTimings = None):
+        """ Runs every stage of every engine on an image.
+        :param image: The BGR image.
+        :param timings: Where to record the duration of each stage, nothing is recorded if None.
+        :return: The processed image and the list of decoded results, in engine order.
+        """
+        results, latencies = self.infer(image, timings)
+        t0 = perf_counter()
+        image = self.draw(image, results, latencies)
+        if timings is not None:
+            timings.record('annotate', perf_counter() - t0)
+        return image, results
+
+    def infer(self, image, timings: StageTimings = None):
+        """ Runs the stages up to a decoded result of every engine on an image: preprocess, invoke and postprocess.
+        :param image: The BGR image.
+        :param timings: Where to record the duration of each stage, nothing is recorded if None.
+        :return: The list of decoded results and the list of invoke durations in seconds, in engine order.
+        """
+        t0 = perf_counter()
+        for size, resized in self.resized.items():
+            cv2.resize(image, size, dst=resized, interpolation=cv2.INTER_LINEAR)
+        for engine in self.engines:
+            plan = engine.plan
+            plan.convert(self.resized[(plan.width, plan.height)], plan.input_tensor()[0])
+        t1 = perf_counter()
+        latencies = list(self.executor.map(MultiModelRunner._invoke, [engine.interpreter for engine in self.engines]))
+        t2 = perf_counter()
+        results = [InferenceAdaptor.stages(engine.inference_type)[0](engine.interpreter, engine.plan,
+                                                                     engine.model_path, image.shape, engine.options)
+                   for engine in self.engines]
+        t3 = perf_counter()
+        if timings is not None:
+            timings.record('preprocess', t1 - t0)
+            timings.record('invoke', t2 - t1)
+            timings.record('postprocess', t3 - t2)
+        return results, latencies
+
+    def draw(self, image, results: list, latencies: list):
+        """ Draws the results of every engine with the runner's layout.
+        :param image: The BGR image.
+        :param results: The decoded results, in engine order.
+        :param latencies: The invoke durations in seconds, in engine order.
+        :return: The processed image.
+        """
+        if self.layout == 'composite':
+            return self.draw_composite(image, results, latencies)
+        return self.draw_side_by_side(image, results, latencies)
+
+    def draw_side_by_side(self, image, results: list, latencies: list):
+        """ Draws each result on its own copy of the image and lays the copies out left to right.
+        :param image: The BGR image.
+        :param results: The decoded results, in engine order.
+        :param latencies: The invoke durations in seconds, in engine order.
+        :return: A new canvas holding every copy.
+        """
+        for index, (engine, result, latency) in enumerate(zip(self.engines, results, latencies)):
+            tile = self.tiles[index]
+            if tile is None or tile.shape != image.shape:
+                tile = self.tiles[index] = np.empty_like(image)
+            np.copyto(tile, image)
+            self.tiles[index] = InferenceAdaptor.draw(engine, tile, result, latency)
+        # A new canvas every frame, the encode stage may still be reading the previous one while this one is drawn.
+        return cv2.hconcat(self.tiles)
+
+    def draw_composite(self, image, results: list, latencies: list):
+        """ Draws every result on the image itself, segmentation masks first so the other results stay visible.
+        :param image: The BGR image, it is drawn on in place.
+        :param results: The decoded results, in engine order.
+        :param latencies: The invoke durations in seconds, in engine order.
+        :return: The image.
+        """
+        order = sorted(range(len(self.engines)), key=lambda i: self.engines[i].inference_type != 'segmentation')
+        info_y = 0
+        for index in order:
+            engine = self.engines[index]
+            options = engine.options
+            if engine.inference_type == 'segmentation' and options['segmentation_alpha'] is None:
+                # Replacing the image would hide what the other models found, blend the mask instead.
+                options = dict(options, segmentation_alpha=0.5)
+            image = InferenceAdaptor.draw_result(engine.inference_type, image, results[index], options)
+        for index, engine in enumerate(self.engines):
+            info = f'{engine.model_path.split("/")[-1]} - latency: {latencies[index] * 1000:.2f} ms'
+            info_size, _ = cv2.getTextSize(info, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+            info_y += info_size[1] + 5
+            cv2.putText(image, info, (10, info_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, InferenceAdaptor.coral_bgr, 1)
         return image
 
+    def close(self):
+        """ Stops the worker threads.
+        :return: None
+        """
+        self.executor.shutdown(wait=False)
+
+
+class Stream:
+    """
+    A single video feed of coral cam: a frame source, the engine that processes its frames and, in pipelined mode, the
+    Pipeline that runs it. Streams share the interpreter pool and the inference scheduler of their CoralCam, and each
+    records its own stage timings.
+    """
+
+    def __init__(self, name: str, source, pool: InterpreterPool, timings: StageTimings,
+                 scheduler: InferenceScheduler):
+        """
+        :param name: The name of the stream.
+        :param source: Where to pull frames from, anything sources.open_source() accepts.
+        :param pool: The interpreter pool engines are taken from.
+        :param timings: Where to record the per stage durations of this stream.
+        :param scheduler: The scheduler that runs inference for every pipelined stream, its lock is held around every
+        invoke that doesn't run in a worker process.
+        """
+        self.name = name
+        self.source_spec = source  # What the source is opened from.
+        self.capture_options = {}  # The width, height and fourcc asked from cameras, see set_source().
+        # The frame source, opened when the first frame is asked for so that creating a stream is cheap.
+        self.source = None
+        self.source_lock = threading.Lock()
+        self.pool = pool
+        self.timings = timings
+        self.scheduler = scheduler
+        # The Engine or MultiModelRunner frames are processed with, None passes frames through untouched.
+        self.active = None
+        self.switch_lock = threading.Lock()
+        self.switch_requests = 0  # Incremented by every set_engine() call, so only the latest request takes effect.
+        self.in_use = {}  # id() of an engine -> number of frames being processed with it.
+        self.in_use_cond = threading.Condition()
+        self.fps = None  # Target frame rate, None for as fast as possible.
+        self.encoder = JpegEncoder()  # Encodes the processed frames, see CoralCam.set_encoding().
+        self.temporal = None  # The TemporalReuse deciding which frames to skip, None runs inference on every frame.
+        self.pipeline = None  # The Pipeline when running in pipelined mode.
+        self.last_seq = 0  # Sequence number of the last frame handed out by get_frame()...
+        self.last_pipeline = None  # ...and the pipeline it came from, a new pipeline numbers its frames from 1 again.
+
+    def set_source(self, source, width: int = None, height: int = None, fourcc: str = None):
+        """ Switch the frame source. Like the initial one, it is opened when the next frame is asked for.
+        :param source: Anything sources.open_source() accepts.
+        :param width: The frame width to request from cameras, sources.open_source()'s default if None.
+        :param height: The frame height to request from cameras, sources.open_source()'s default if None.
+        :param fourcc: The pixel format to request from cameras, e.g. 'MJPG' or 'YUYV'.
+        :return: None
+        """
+        pipeline = self.pipeline
+        self.stop_pipeline()
+        with self.source_lock:
+            if self.source is not None:
+                self.source.release()
+            self.source_spec = source
+            self.capture_options = {name: value for name, value in
+                                    (('width', width), ('height', height), ('fourcc', fourcc)) if value is not None}
+            self.source = None
+        if pipeline is not None:
+            self.start_pipeline(pipeline.capture_queue.maxsize)
+
+    def open_source(self):
+        """ Opens the frame source if it isn't open yet.
+        :return: The FrameSource.
+        """
+        with self.source_lock:
+            if self.source is None:
+                with self.timings.time('source_open'):
+                    self.source = open_source(self.source_spec, **self.capture_options)
+            return self.source
+
+    @property
+    def engine(self):
+        """ :return: The interpreter of the active engine, or None. """
+        active = self.active
+        return active.interpreter if isinstance(active, Engine) else None
+
+    @property
+    def inference_type(self):
+        """ :return: The inference type of the active engine, or None. """
+        active = self.active
+        return active.inference_type if active is not None else None
+
+    @property
+    def current_model(self):
+        """ :return: The model path of the active engine, or None. """
+        active = self.active
+        return active.model_path if active is not None else None
+
+    def set_engine(self, inference_type: str, model: str, edgetpu: bool, options: dict, cpu_workers: int = 0,
+                   warmup_runs: int = None):
+        """ Switch the inference engine. The new engine is built and allocated while frames keep being processed with
+        the current one, then swapped in at once. Call it off the hot path, building an interpreter can take seconds.
+        :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        :param model: The name of the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :param cpu_workers: Without the edgetpu, run the model in this many worker processes if more than 1.
+        :param warmup_runs: The number of warm-up invokes if the interpreter isn't pooled yet, the pool's default if
+        None.
+        :return: The time it took to switch in milliseconds, or None if a later call superseded this one.
+        :except: Exception: If the interpreter could not be built, the current engine is kept.
+        """
+        with self.switch_lock:
+            self.switch_requests += 1
+            request = self.switch_requests
+        model_path = ModelUtils.get_model_path(model, edgetpu)
+        options = dict(InferenceAdaptor.default_options, **options)
+        t0 = time()
+        if not edgetpu and cpu_workers > 1:
+            engine = ProcessPoolRunner(model_path, inference_type, options, cpu_workers)
+        else:
+            # Interpreters come out of the pool allocated and warmed up, switching back to a recently used model is
+            # close to free. Streams running the same model share the interpreter, the scheduler never runs it
+            # concurrently.
+            interpreter = self.pool.get(model_path, edgetpu, warmup_runs)
+            engine = Engine(interpreter, inference_type, model_path, PreprocessPlan(interpreter), options)
+        switch_time = (time() - t0) * 1000
+        return switch_time if self._swap(request, engine, switch_time) else None
+
+    def set_models(self, models: list, edgetpu: bool, layout: str, options: dict):
+        """ Switch to running several models on every frame, see MultiModelRunner. Like set_engine(), the models are
+        built while frames keep being processed with the current engine.
+        :param models: The names of the models, their inference types are looked up.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param layout: One of MultiModelRunner.layouts.
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :return: The time it took to switch in milliseconds, or None if a later call superseded this one.
+        :except: Exception: If an interpreter could not be built, the current engine is kept.
+        """
+        with self.switch_lock:
+            self.switch_requests += 1
+            request = self.switch_requests
+        t0 = time()
+        engines = []
+        for model in models:
+            model_path = ModelUtils.get_model_path(model, edgetpu)
+            interpreter = self.pool.get(model_path, edgetpu)
+            engines.append(Engine(interpreter, ModelUtils.get_inference_type(model), model_path,
+                                  PreprocessPlan(interpreter), dict(InferenceAdaptor.default_options, **options)))
+        runner = MultiModelRunner(engines, layout)
+        switch_time = (time() - t0) * 1000
+        return switch_time if self._swap(request, runner, switch_time) else None
+
+    def _swap(self, request: int, active, switch_time: float):
+        """ Makes a newly built engine the active one, unless a later switch was requested meanwhile.
+        :param request: The switch request the engine was built for.
+        :param active: The Engine, MultiModelRunner or ProcessPoolRunner.
+        :param switch_time: The time it took to build in milliseconds.
+        :return: Whether the engine was swapped in.
+        """
+        with self.switch_lock:
+            superseded = request != self.switch_requests
+            if not superseded:
+                previous, pipeline = self.active, self.pipeline
+                # Worker processes are fed by the pipeline's own inference threads rather than the shared scheduler,
+                # one thread per worker. Those threads must be gone before an in-process engine is swapped in, they
+                # would run its interpreter concurrently and outside of the scheduler lock.
+                restart = (pipeline is not None
+                           and Stream.inference_workers(previous) != Stream.inference_workers(active))
+                if restart:
+                    self.stop_pipeline()
+                self.active = active
+                if restart:
+                    self.start_pipeline(pipeline.capture_queue.maxsize)
+        if superseded:
+            if not isinstance(active, Engine):
+                active.close()
+            return False
+        self.timings.record('engine_switch', switch_time / 1000)
+        if previous is not None and not isinstance(previous, Engine):
+            self._retire(previous)
+        return True
+
+    @staticmethod
+    def inference_workers(active):
+        """ :return: The number of inference threads a pipeline runs for an engine, 0 if it uses the scheduler. """
+        return active.num_workers if isinstance(active, ProcessPoolRunner) else 0
+
+    def _retire(self, previous, timeout: float = 10.0):
+        """ Closes an engine that was swapped out, once the frames that were already being processed with it are done.
+        :param previous: The MultiModelRunner or ProcessPoolRunner.
+        :param timeout: The maximum number of seconds to wait for those frames.
+        :return: None
+        """
+        with self.in_use_cond:
+            self.in_use_cond.wait_for(lambda: id(previous) not in self.in_use, timeout)
+        previous.close()
+
+    def set_fps(self, fps: float = None):
+        """ Set the target frame rate of the stream.
+        :param fps: The target frame rate, None for as fast as possible.
+        :return: None
+        """
+        self.fps = fps
+        if self.pipeline is not None:
+            self.pipeline.set_fps(fps)
+
+    def read_frame(self):
+        """ Captures the next frame from the source.
+        :return: The Frame, or None if the source has nothing to offer.
+        """
+        source = self.open_source()
+        with self.timings.time('capture'):
+            return source.read()
+
+    def process_frame(self, image):
+        """ Run inference on an image and label it according to the current inference type.
+        :param image: The BGR image.
+        :return: The processed image.
+        """
+        # Read the engine once, set_engine() may swap it at any time. It isn't closed before the frame is done.
+        with self.in_use_cond:
+            active = self.active
+            if active is None:
+                return image
+            self.in_use[id(active)] = self.in_use.get(id(active), 0) + 1
+        try:
+            return self._process_with(active, image)
+        finally:
+            with self.in_use_cond:
+                self.in_use[id(active)] -= 1
+                if not self.in_use[id(active)]:
+                    del self.in_use[id(active)]
+                    self.in_use_cond.notify_all()
+
+    def _process_with(self, active, image):
+        """ Runs inference on an image with an engine and labels it.
+        :param active: The Engine, MultiModelRunner or ProcessPoolRunner.
+        :param image: The BGR image.
+        :return: The processed image.
+        """
+        temporal = self.temporal
+        if temporal is None or temporal.should_infer(image, active):
+            # Streams may share interpreters, and edgetpu invokes don't overlap well anyway, take turns for the stages
+            # that touch the interpreter. Drawing only touches the frame, so it runs alongside other streams' invokes.
+            # Worker processes have interpreters of their own.
+            with nullcontext() if isinstance(active, ProcessPoolRunner) else self.scheduler.lock:
+                if isinstance(active, Engine):
+                    result, latency = InferenceAdaptor.infer(active.interpreter, image, active.inference_type,
+                                                             active.model_path, active.plan, self.timings,
+                                                             active.options)
+                else:
+                    result, latency = active.infer(image, self.timings)
+            if temporal is not None:
+                result = temporal.update(active, result, latency)
+        else:
+            result, latency = temporal.last()
+        with self.timings.time('annotate'):
+            if isinstance(active, Engine):
+                return InferenceAdaptor.draw(active, image, result, latency)
+            return active.draw(image, result, latency)
+
+    def start_pipeline(self, queue_size: int = 1):
+        """ Switch to pipelined mode, where capture and encoding run on their own threads and inference runs on the
+        shared scheduler thread.
+        :param queue_size: How many frames each stage may queue up before the oldest is dropped.
+        :return: None
+        """
+        if self.pipeline is not None:
+            return
+        active = self.active
+        if isinstance(active, ProcessPoolRunner):
+            # Keep every worker process busy with a frame of its own.
+            scheduler, workers = None, active.num_workers
+        else:
+            scheduler, workers = self.scheduler, 1
+        self.pipeline = Pipeline(self.open_source(), self.process_frame, self.encoder.encode, queue_size=queue_size,
+                                 timings=self.timings, scheduler=scheduler, fps=self.fps, inference_workers=workers)
+        self.pipeline.start()
+
+    def stop_pipeline(self):
+        """ Switch back to the serial mode, where get_frame() does every step on the calling thread.
+        :return: None
+        """
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+
+    def get_frame(self):
+        """ Captures the image from the source, run inference and label the image. In pipelined mode this waits for
+        the next frame the pipeline produces instead.
+        :return: The processed image as JPEG bytes.
+        """
+        pipeline = self.pipeline
+        if pipeline is not None:
+            frame = pipeline.wait_for_frame(self.last_seq if self.last_pipeline is pipeline else 0, timeout=1.0)
+            if frame is None:
+                return None
+            self.last_pipeline, self.last_seq = pipeline, frame.seq
+            return frame.image
+
+        frame = self.read_frame()
+        if frame is not None:
+            with self.timings.time('inference'):
+                image = self.process_frame(frame.image)
+            with self.timings.time('encode'):
+                data = self.encoder.encode(image)
+            self.timings.record('latency', time() - frame.timestamp)
+            return data
+        return None
+
+    def describe(self):
+        """ :return: A JSON friendly description of the stream. """
+        return {'name': self.name, 'source': str(self.source_spec), 'inference_type': self.inference_type,
+                'model': self.current_model, 'fps': self.fps, 'pipelined': self.pipeline is not None}
+
+    def release(self):
+        """ Stops the stream and releases its source.
+        :return: None
+        """
+        self.stop_pipeline()
+        with self.source_lock:
+            if self.source is not None:
+                self.source.release()
+                self.source = None
+        if self.active is not None and not isinstance(self.active, Engine):
+            self._retire(self.active)
+
 
 class CoralCam(object):
-    """ CoralCam is a singleton class that essentially acts as a normal camera with added AI functionality."""
+    """
+    CoralCam is a singleton class that essentially acts as a normal camera with added AI functionality. It manages
+    any number of named streams, the 'default' one reads from camera 0 unless told otherwise.
+    """
     __instance = None  # The Coral Cam instance.
+    # Messages waiting to be sent to the UI, None until forward_log() runs. eel's websocket belongs to the gevent loop,
+    # so threads hand their messages to a greenlet instead of writing to it themselves.
+    log_queue = None
 
-    def __new__(cls):
-        """ Constructor for the CoralCam singleton. """
+    def __new__(cls, source=0):
+        """ Constructor for the CoralCam singleton.
+        :param source: Where the default stream pulls frames from, anything sources.open_source() accepts.
+        """
         if CoralCam.__instance is None:
             CoralCam.__instance = object.__new__(cls)
-        CoralCam.__instance.video = cv2.VideoCapture(0)  # The cv2 camera capture.
-        CoralCam.__instance.video.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        CoralCam.__instance.video.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-        CoralCam.__instance.current_model = None  # Stores current model path.
-        CoralCam.__instance.inference_type = None  # [classification, detection, pose-estimation]
-        CoralCam.__instance.engine = None  # Inference Engine
+            CoralCam.__instance.pool = InterpreterPool()  # Ready to use interpreters, shared by every stream.
+            CoralCam.__instance.pool.on_cold_start = CoralCam.log_cold_start
+            CoralCam.__instance.metrics = Metrics()  # Stage timings, counters and gauges, see get_metrics().
+            CoralCam.__instance.metrics.add_collector(CoralCam.__instance._collect_pipeline_metrics)
+            CoralCam.__instance.scheduler = InferenceScheduler()  # Runs inference for every pipelined stream.
+            CoralCam.__instance.cpu_workers = 0  # Worker processes cpu models run in, see set_engine().
+            CoralCam.__instance.streams = {}  # Stream name -> Stream.
+            CoralCam.__instance.add_stream('default', source)
         return CoralCam.__instance
 
     def __del__(self):
         """ Destructor. """
-        self.__instance.video.release()
+        for stream in list(self.__instance.streams.values()):
+            stream.release()
+        self.__instance.scheduler.stop()
 
-    def set_engine(self, inference_type, model: str, edgetpu: bool):
-        """ Switch the inference engine.
+    @staticmethod
+    def log(msg: str):
+        """ Sends a message to the log console of the UI, or prints it when running without the UI. Safe to call from
+        any thread.
+        :param msg: The message.
+        :return: None
+        """
+        log_queue = CoralCam.log_queue
+        if log_queue is None:
+            # Running headless, or eel hasn't been initialized yet.
+            print(msg)
+        else:
+            log_queue.put(msg)
+
+    @staticmethod
+    def forward_log(poll_interval: float = 0.05):
+        """ Starts a greenlet sending the messages passed to log() to the UI, call it once eel is initialized.
+        :param poll_interval: How many seconds to wait between checks for new messages.
+        :return: None
+        """
+        if CoralCam.log_queue is not None:
+            return
+        CoralCam.log_queue = queue.SimpleQueue()
+
+        def run():
+            while True:
+                try:
+                    msg = CoralCam.log_queue.get_nowait()
+                except queue.Empty:
+                    # A blocking get() would block the whole gevent loop, poll with a cooperative sleep instead.
+                    eel.sleep(poll_interval)
+                    continue
+                try:
+                    eel.updateLog(msg)
+                except AttributeError:
+                    # The page hasn't exposed updateLog yet.
+                    print(msg)
+
+        eel.spawn(run)
+
+    @staticmethod
+    def log_cold_start(cold_start: ColdStart):
+        """ Reports how long a new interpreter took to become ready to the log.
+        :param cold_start: The ColdStart.
+        :return: None
+        """
+        first, steady = ('n/a' if ms is None else f'{ms:.2f} ms'
+                         for ms in (cold_start.first_invoke_ms, cold_start.steady_invoke_ms))
+        CoralCam.log(f'Cold start: {os.path.basename(cold_start.model_path)} '
+                     f'({"edgetpu" if cold_start.edgetpu else "cpu"}) - load: {cold_start.load_ms:.2f} ms - '
+                     f'allocate: {cold_start.allocate_ms:.2f} ms - first invoke: {first} - steady invoke: {steady}')
+
+    def stream(self, name: str = 'default'):
+        """ Get a stream by name.
+        :param name: The name of the stream.
+        :return: The Stream.
+        :except: KeyError: If there is no such stream.
+        """
+        return self.__instance.streams[name]
+
+    def add_stream(self, name: str, source, inference_type: str = None, model: str = None, edgetpu: bool = False,
+                   fps: float = None, pipelined: bool = False, models: list = None, layout: str = 'side-by-side',
+                   **options):
+        """ Add a stream, optionally setting its engine and starting its pipeline right away.
+        :param name: The name of the stream.
+        :param source: Where to pull frames from, anything sources.open_source() accepts.
+        :param inference_type: The inference mode, the stream passes frames through untouched if None.
+        :param model: The name of the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param fps: Target frame rate, None for as fast as possible.
+        :param pipelined: Whether to start the stream's pipeline.
+        :param models: The names of several models to run on every frame instead, see set_models().
+        :param layout: How the results of several models are laid out, see set_models().
+        :param options: The engine options, see set_engine().
+        :return: The Stream.
+        """
+        if name in self.__instance.streams:
+            self.remove_stream(name)
+        stream = Stream(name, source, self.__instance.pool, self.__instance.metrics.add_stream_timings(name),
+                        self.__instance.scheduler)
+        stream.set_fps(fps)
+        self.__instance.streams[name] = stream
+        if models:
+            self.set_models(models, edgetpu, layout, stream=name, **options)
+        elif inference_type is not None and model is not None:
+            self.set_engine(inference_type, model, edgetpu, stream=name, **options)
+        if pipelined:
+            stream.start_pipeline()
+        return stream
+
+    def remove_stream(self, name: str):
+        """ Stop and remove a stream.
+        :param name: The name of the stream.
+        :return: None
+        """
+        stream = self.__instance.streams.pop(name, None)
+        if stream is not None:
+            stream.release()
+            self.__instance.metrics.remove_stream_timings(name)
+
+    def list_streams(self):
+        """ :return: A JSON friendly description of every stream. """
+        return [stream.describe() for stream in self.__instance.streams.values()]
+
+    def set_source(self, source, stream: str = 'default', width: int = None, height: int = None, fourcc: str = None):
+        """ Switch the frame source, e.g. to a video file or a directory of images instead of the camera. The source is
+        opened when the next frame is asked for.
+        :param source: Anything sources.open_source() accepts.
+        :param stream: The name of the stream.
+        :param width: The frame width to request from cameras, sources.open_source()'s default if None.
+        :param height: The frame height to request from cameras, sources.open_source()'s default if None.
+        :param fourcc: The pixel format to request from cameras, e.g. 'MJPG' or 'YUYV'.
+        :return: None
+        """
+        self.stream(stream).set_source(source, width, height, fourcc)
+
+    def set_engine(self, inference_type, model: str, edgetpu: bool, score_threshold: float = 0.5,
+                   max_detections: int = None, segmentation_alpha: float = None, pose_score_threshold: float = 0.2,
+                   keypoint_score_threshold: float = 0.5, stream: str = 'default',
+                   wait: bool = False, cpu_workers: int = None, warmup_runs: int = None):
+        """ Switch the inference engine. The engine is built on a background thread and the stream keeps running with
+        the current one until it is ready, the outcome is reported to the log.
         :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
         :param model: The name of the model.
         :param edgetpu: Whether to use the edgetpu or not.
+        :param score_threshold: Detections scoring at or below this are dropped.
+        :param max_detections: Keep at most this many detections, None keeps all.
+        :param segmentation_alpha: Opacity of the segmentation mask over the camera image, None replaces the image.
+        :param pose_score_threshold: Poses scoring at or below this are dropped.
+        :param keypoint_score_threshold: Keypoints scoring at or below this are not drawn.
+        :param stream: The name of the stream.
+        :param wait: Whether to wait for the switch to finish.
+        :param cpu_workers: Without the edgetpu, run the model in this many worker processes if more than 1, the
+        cpu_workers attribute if None.
+        :param warmup_runs: The number of invokes on synthetic input before a newly built interpreter is used, the
+        pool's warmup_runs if None. Their timings are reported to the log and by get_cold_starts().
         :return: None
         """
-        current_model = ModelUtils.get_model_path(model, edgetpu)
-        if edgetpu:
+        target = self.stream(stream)
+        options = {'score_threshold': score_threshold, 'max_detections': max_detections,
+                   'segmentation_alpha': segmentation_alpha, 'pose_score_threshold': pose_score_threshold,
+                   'keypoint_score_threshold': keypoint_score_threshold}
+        model_path = ModelUtils.get_model_path(model, edgetpu)
+        workers = self.__instance.cpu_workers if cpu_workers is None else cpu_workers
+        self._switch_engine(target,
+                            lambda: target.set_engine(inference_type, model, edgetpu, options, workers, warmup_runs),
+                            f'Mode: {inference_type} - model name: {model} - model path: {model_path}', edgetpu, wait)
+
+    def set_models(self, models: list, edgetpu: bool, layout: str = 'side-by-side', score_threshold: float = 0.5,
+                   max_detections: int = None, segmentation_alpha: float = None, pose_score_threshold: float = 0.2,
+                   keypoint_score_threshold: float = 0.5, stream: str = 'default',
+                   wait: bool = False):
+        """ Run several models on every frame, e.g. to compare them. Like set_engine(), the models are built on a
+        background thread and the outcome is reported to the log.
+        :param models: The names of the models, their inference types are looked up.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param layout: 'side-by-side' to draw each model on its own copy of the frame, 'composite' to draw them all on
+        the frame itself.
+        :param score_threshold: Detections scoring at or below this are dropped.
+        :param max_detections: Keep at most this many detections, None keeps all.
+        :param segmentation_alpha: Opacity of the segmentation mask over the camera image, None replaces the image.
+        :param pose_score_threshold: Poses scoring at or below this are dropped.
+        :param keypoint_score_threshold: Keypoints scoring at or below this are not drawn.
+        :param stream: The name of the stream.
+        :param wait: Whether to wait for the switch to finish.
+        :return: None
+        """
+        target = self.stream(stream)
+        options = {'score_threshold': score_threshold, 'max_detections': max_detections,
+                   'segmentation_alpha': segmentation_alpha, 'pose_score_threshold': pose_score_threshold,
+                   'keypoint_score_threshold': keypoint_score_threshold}
+        self._switch_engine(target, lambda: target.set_models(models, edgetpu, layout, options),
+                            f'Mode: multi-model ({layout}) - model names: {", ".join(models)}', edgetpu, wait)
+
+    @staticmethod
+    def _switch_engine(target: Stream, switch, description: str, edgetpu: bool, wait: bool):
+        """ Switches the engine of a stream on a background thread and logs the outcome.
+        :param target: The Stream.
+        :param switch: Does the switch, returns the switch time in milliseconds or None if it was superseded.
+        :param description: Describes the new engine in the log.
+        :param edgetpu: Whether the edgetpu is used.
+        :param wait: Whether to wait for the switch to finish.
+        :return: None
+        """
+        def run():
             try:
-                if 'posenet' in current_model:
-                    self.__instance.engine = Interpreter(
-                        current_model,
-                        experimental_delegates=[load_delegate(EDGETPU_SHARED_LIB), load_delegate(POSENET_SHARED_LIB)])
-                else:
-                    self.__instance.engine = Interpreter(
-                        current_model,
-                        experimental_delegates=[load_delegate(EDGETPU_SHARED_LIB)])
+                switch_time = switch()
             except Exception as e:
-                msg = f'Failed to switch to edgetpu model, reason: {e}'
-                eel.updateLog(msg)()
+                msg = f'Failed to switch to {"edgetpu" if edgetpu else "cpu"} model, reason: {e}'
+                CoralCam.log(msg)
                 return
-        else:
-            if 'posenet' in current_model:
-                self.__instance.engine = Interpreter(current_model,
-                                                     experimental_delegates=[load_delegate(POSENET_SHARED_LIB)])
-            else:
-                self.__instance.engine = Interpreter(current_model)
+            if switch_time is None:
+                # A later switch was requested while this one was building, that one gets reported instead.
+                return
+            prefix = '' if target.name == 'default' else f'Stream: {target.name} - '
+            CoralCam.log(f'{prefix}{description} - switch time: {switch_time:.2f} ms')
 
-        self.__instance.current_model = ModelUtils.get_model_path(model, edgetpu)
-        self.__instance.inference_type = inference_type
+        thread = threading.Thread(target=run, name='coral-cam-engine-switch', daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
 
-        # Initialize new model.
-        self.__instance.engine.allocate_tensors()
+    def set_fps(self, fps: float = None, stream: str = 'default'):
+        """ Set the target frame rate of a stream.
+        :param fps: The target frame rate, None for as fast as possible.
+        :param stream: The name of the stream.
+        :return: None
+        """
+        self.stream(stream).set_fps(fps)
 
-        msg = f'Mode: {self.__instance.inference_type} - model name: {model} - model path: {self.__instance.current_model} '
-        eel.updateLog(msg)()
+    def set_encoding(self, quality: int = None, width: int = None, height: int = None, adaptive: bool = None,
+                     target_fps: float = None, stream: str = 'default'):
+        """ Change how the frames of a stream are encoded, arguments left as None are kept.
+        :param quality: The JPEG quality in [1, 100], the upper bound in adaptive mode.
+        :param width: The output width, 0 keeps the frame width.
+        :param height: The output height, 0 keeps the frame height.
+        :param adaptive: Whether to lower quality and resolution when encoding or viewers fall behind.
+        :param target_fps: The frame rate adaptive mode tries to keep up with, 0 only reacts to skipped frames.
+        :param stream: The name of the stream.
+        :return: None
+        """
+        self.stream(stream).encoder.configure(quality, width, height, adaptive, target_fps)
 
-    def get_frame(self):
-        """ Captures the image from the camera, run inference and label the image.
+    def set_temporal_reuse(self, enabled: bool, threshold: float = 3.0, keyframe_interval: int = 30,
+                           smoothing: float = 0.5, stream: str = 'default'):
+        """ Skip inference on frames that barely changed, reusing the last result, see TemporalReuse.
+        :param enabled: Whether to skip inference on static frames.
+        :param threshold: Frames whose mean absolute difference to the last keyframe, in gray levels, is at or below
+        this reuse the last result.
+        :param keyframe_interval: Inference runs at least once every this many frames.
+        :param smoothing: The weight of a new detection or pose against the one it matches, 1 disables smoothing.
+        :param stream: The name of the stream.
+        :return: None
+        """
+        target = self.stream(stream)
+        target.temporal = TemporalReuse(threshold, keyframe_interval, smoothing) if enabled else None
+
+    def prewarm(self, model: str, edgetpu: bool, warmup_runs: int = None):
+        """ Build and warm up the interpreter of a model in the background, so switching to it later is instant.
+        :param model: The name of the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param warmup_runs: The number of warm-up invokes, the pool's warmup_runs if None.
+        :return: The background thread, or None if the interpreter is pooled already.
+        """
+        current_model = ModelUtils.get_model_path(model, edgetpu)
+        if self.__instance.pool.contains(current_model, edgetpu):
+            return None
+        return self.__instance.pool.warm_up(
+            current_model, edgetpu, lambda e: CoralCam.log(f'Failed to prewarm {model}, reason: {e}'), warmup_runs)
+
+    def get_cold_starts(self):
+        """ Get how long the interpreter of every model built so far took to load, allocate, invoke for the first time
+        and invoke once warm.
+        :return: A list of ColdStart dicts, times in milliseconds.
+        """
+        return [cold_start._asdict() for cold_start in self.__instance.pool.cold_start_stats()]
+
+    def read_frame(self, stream: str = 'default'):
+        """ Captures the next frame from the source of a stream.
+        :param stream: The name of the stream.
+        :return: The Frame, or None if the source has nothing to offer.
+        """
+        return self.stream(stream).read_frame()
+
+    def process_frame(self, image, stream: str = 'default'):
+        """ Run inference on an image and label it according to the current inference type of a stream.
+        :param image: The BGR image.
+        :param stream: The name of the stream.
         :return: The processed image.
         """
-        success, image = self.__instance.video.read()
-        if success:
-            if self.__instance.inference_type == 'classification':
-                image = InferenceAdaptor.classify(self.__instance.engine, image, self.__instance.current_model)
-            elif self.__instance.inference_type == 'detection':
-                image = InferenceAdaptor.detect(self.__instance.engine, image, self.__instance.current_model)
-            elif self.__instance.inference_type == 'pose-estimation':
-                image = InferenceAdaptor.pose_estimate(self.__instance.engine, image, self.__instance.current_model)
-            else:
-                image = InferenceAdaptor.segmentation(self.__instance.engine, image, self.__instance.current_model)
-
-            # We are using Motion JPEG, but OpenCV defaults to capture raw images,
-            # so we must encode it into JPEG in order to correctly display the
-            # video stream.
-            ret, jpeg = cv2.imencode('.jpg', image)
-            if ret:
-                return jpeg.tobytes()
-        return None
+        return self.stream(stream).process_frame(image)
+
+    def start_pipeline(self, queue_size: int = 1, stream: str = 'default'):
+        """ Switch a stream to pipelined mode, where capture, inference and encoding run concurrently.
+        :param queue_size: How many frames each stage may queue up before the oldest is dropped.
+        :param stream: The name of the stream.
+        :return: None
+        """
+        self.stream(stream).start_pipeline(queue_size)
+
+    def stop_pipeline(self, stream: str = 'default'):
+        """ Switch a stream back to the serial mode, where get_frame() does every step on the calling thread.
+        :param stream: The name of the stream.
+        :return: None
+        """
+        self.stream(stream).stop_pipeline()
+
+    def get_stage_timings(self, stream: str = 'default'):
+        """ Get the per stage durations of a stream, useful to find out which stage limits its throughput.
+        :param stream: The name of the stream.
+        :return: A dict of stage name to its summary, plus the name of the bottleneck stage and the dropped frames of
+        every pipelined stream.
+        """
+        timings = self.stream(stream).timings
+        return {'stages': timings.summary(), 'bottleneck': timings.bottleneck(),
+                'dropped_frames': {name: stream.pipeline.dropped_frames()
+                                   for name, stream in self.__instance.streams.items() if stream.pipeline is not None}}
+
+    def get_metrics(self, stream: str = 'default'):
+        """ Get a JSON friendly snapshot of every metric, for the UI to poll.
+        :param stream: The stream to summarize the stages of.
+        :return: See Metrics.snapshot().
+        """
+        return self.__instance.metrics.snapshot(stream)
+
+    def _collect_pipeline_metrics(self):
+        """ Reports the JPEG settings and reused results of every stream, the queue depths and dropped frames of every
+        pipeline and the cold start of every model, see Metrics.add_collector(). """
+        samples = []
+        for cold_start in self.__instance.pool.cold_start_stats():
+            labels = {'model': os.path.basename(cold_start.model_path),
+                      'device': 'edgetpu' if cold_start.edgetpu else 'cpu'}
+            phases = {'load': cold_start.load_ms, 'allocate': cold_start.allocate_ms,
+                      'first_invoke': cold_start.first_invoke_ms, 'steady_invoke': cold_start.steady_invoke_ms}
+            samples += [('gauge', 'cold_start_ms', dict(labels, phase=phase), value)
+                        for phase, value in phases.items() if value is not None]
+        for name, stream in list(self.__instance.streams.items()):
+            scale, quality = stream.encoder.current_settings()
+            samples += [('gauge', 'jpeg_quality', {'stream': name}, quality),
+                        ('gauge', 'jpeg_scale', {'stream': name}, scale)]
+            temporal = stream.temporal
+            if temporal is not None:
+                samples += [('counter', 'frames_inferred_total', {'stream': name}, temporal.inferred),
+                            ('counter', 'frames_reused_total', {'stream': name}, temporal.reused),
+                            ('gauge', 'frame_difference', {'stream': name}, temporal.score)]
+            pipeline = stream.pipeline
+            if pipeline is None:
+                continue
+            samples += [('gauge', 'queue_depth', {'stream': name, 'queue': 'capture'}, len(pipeline.capture_queue)),
+                        ('gauge', 'queue_depth', {'stream': name, 'queue': 'encode'}, len(pipeline.encode_queue))]
+            samples += [('counter', 'frames_dropped_total', {'stream': name, 'queue': queue}, dropped)
+                        for queue, dropped in pipeline.dropped_frames().items()]
+        return samples
+
+    def get_frame(self, stream: str = 'default'):
+        """ Captures the image from the camera, run inference and label the image. In pipelined mode this waits for
+        the next frame the pipeline produces instead.
+        :param stream: The name of the stream.
+        :return: The processed image as JPEG bytes.
+        """
+        return self.stream(stream).get_frame()
@@ -0,0 +1,252 @@
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing import shared_memory
+from time import perf_counter
+
+import numpy as np
+
+from metrics import StageTimings
+
+
+def _worker(conn, model_path: str, inference_type: str, options: dict, num_threads: int):
+    """ Runs in a worker process: preprocesses, invokes and decodes the frames the parent puts in shared memory.
+    :param conn: The worker's end of the pipe to the parent.
+    :param model_path: The path to the cpu model.
+    :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+    :param options: The engine options, see InferenceAdaptor.default_options.
+    :param num_threads: The number of threads the interpreter runs ops on.
+    :return: None
+    """
+    # Imported here, coral_cam imports this module.
+    from coral_cam import InferenceAdaptor
+    from engine_pool import InterpreterPool
+    from preprocess import PreprocessPlan
+
+    interpreter = InterpreterPool(max_entries=1, cpu_threads=num_threads).get(model_path, False)
+    plan = PreprocessPlan(interpreter)
+    decode, _ = InferenceAdaptor.stages(inference_type)
+    slot = None
+    conn.send(('ready', (plan.width, plan.height)))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        command, argument = message
+        if command == 'attach':
+            if slot is not None:
+                slot.close()
+            slot = shared_memory.SharedMemory(name=argument)
+            conn.send('attached')
+            continue
+        image = np.ndarray(argument, dtype=np.uint8, buffer=slot.buf)
+        try:
+            t0 = perf_counter()
+            plan.fill(image)
+            t1 = perf_counter()
+            interpreter.invoke()
+            t2 = perf_counter()
+            result = decode(interpreter, plan, model_path, argument, options)
+            t3 = perf_counter()
+        except Exception as e:
+            # Report it to the parent, a frame that fails must not take the worker down with it.
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+            continue
+        finally:
+            del image
+        conn.send(('result', (result, t1 - t0, t2 - t1, t3 - t2)))
+    if slot is not None:
+        slot.close()
+
+
+class ProcessPoolRunner:
+    """
+    Runs a cpu model in a pool of worker processes, each with its own interpreter, so inference is not bound by the
+    GIL of the process that captures, draws and encodes. Every worker owns a shared memory slot frames are copied into,
+    only their shape and the small decoded results go through the pipe. process() blocks until its frame is done, so
+    throughput scales with the number of threads calling it, see Pipeline's inference_workers.
+    """
+
+    def __init__(self, model_path: str, inference_type: str, options: dict, num_workers: int = None,
+                 num_threads: int = 1, frame_shape: tuple = (720, 1280, 3)):
+        """
+        :param model_path: The path to the cpu model.
+        :param inference_type: The inference mode ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        :param options: The engine options, see InferenceAdaptor.default_options.
+        :param num_workers: The number of worker processes, one per core if None.
+        :param num_threads: The number of threads each worker's interpreter runs ops on.
+        :param frame_shape: The expected frame shape, slots grow if a larger frame comes along.
+        """
+        self.model_path = model_path
+        self.inference_type = inference_type
+        self.options = options
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.num_threads = num_threads
+        # Workers are spawned rather than forked, forking a process that runs threads is asking for deadlocks.
+        self.context = multiprocessing.get_context('spawn')
+        self.connections = [None] * self.num_workers
+        self.processes = [None] * self.num_workers
+        self.slots = [None] * self.num_workers
+        self.free = queue.Queue()  # Indices of the workers that are idle, None once they all died.
+        self.lock = threading.Lock()
+        self.workers_alive = self.num_workers  # Workers that died and could not be restarted are out of rotation.
+        self.input_size = None  # The (width, height) of the model input, reported by the workers for the overlay.
+        # Start them all before waiting for any, so the models load in parallel.
+        for index in range(self.num_workers):
+            self._spawn(index)
+        for index in range(self.num_workers):
+            try:
+                self._wait_ready(index)
+            except RuntimeError:
+                self.close()
+                raise
+            self._attach(index, int(np.prod(frame_shape)))
+            self.free.put(index)
+
+    def _spawn(self, index: int):
+        """ Starts a worker process.
+        :param index: The worker index.
+        :return: None
+        """
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=_worker, args=(child, self.model_path, self.inference_type, self.options,
+                                                             self.num_threads),
+                                       name=f'coral-cam-cpu-worker-{index}', daemon=True)
+        process.start()
+        self.connections[index], self.processes[index] = parent, process
+
+    def _wait_ready(self, index: int, timeout: float = 60.0):
+        """ Waits for a worker to load its model.
+        :param index: The worker index.
+        :param timeout: The maximum number of seconds to wait.
+        :return: None
+        :except: RuntimeError: If the worker failed to load the model.
+        """
+        conn = self.connections[index]
+        try:
+            reply = conn.recv() if conn.poll(timeout) else None
+        except (EOFError, OSError):
+            reply = None
+        if not isinstance(reply, tuple) or reply[0] != 'ready':
+            raise RuntimeError(f'cpu worker {index} failed to load {self.model_path}')
+        self.input_size = reply[1]
+
+    def _respawn(self, index: int):
+        """ Replaces a worker whose process died.
+        :param index: The worker index.
+        :return: Whether the new worker is ready.
+        """
+        self.connections[index].close()
+        if self.processes[index].is_alive():
+            self.processes[index].terminate()
+        self.processes[index].join(2.0)
+        self._spawn(index)
+        try:
+            self._wait_ready(index)
+            self._attach(index, self.slots[index].size)
+        except (RuntimeError, EOFError, OSError):
+            return False
+        return True
+
+    def _attach(self, index: int, size: int):
+        """ Gives a worker a new shared memory slot of at least size bytes.
+        :param index: The worker index.
+        :param size: The slot size in bytes.
+        :return: None
+        """
+        slot = shared_memory.SharedMemory(create=True, size=size)
+        self.connections[index].send(('attach', slot.name))
+        self.connections[index].recv()
+        previous, self.slots[index] = self.slots[index], slot
+        if previous is not None:
+            previous.close()
+            previous.unlink()
+
+    def process(self, image, timings: StageTimings = None):
+        """ Runs every stage on an image, inference on the next idle worker.
+        :param image: The BGR image.
+        :param timings: Where to record the duration of each stage, nothing is recorded if None.
+        :return: The processed image and the decoded result.
+        """
+        result, latency = self.infer(image, timings)
+        t0 = perf_counter()
+        image = self.draw(image, result, latency)
+        if timings is not None:
+            timings.record('annotate', perf_counter() - t0)
+        return image, result
+
+    def infer(self, image, timings: StageTimings = None):
+        """ Runs the stages up to a decoded result on the next idle worker: preprocess, invoke and postprocess.
+        :param image: The BGR image.
+        :param timings: Where to record the duration of each stage, nothing is recorded if None.
+        :return: The decoded result and the invoke duration in seconds.
+        :except: RuntimeError: If the worker failed to process the frame or died.
+        """
+        index = self.free.get()
+        if index is None:
+            # Every worker died, wake up the next caller as well.
+            self.free.put(None)
+            raise RuntimeError(f'Every cpu worker running {self.model_path} died')
+        alive = True
+        try:
+            if self.slots[index].size < image.nbytes:
+                self._attach(index, image.nbytes)
+            np.copyto(np.ndarray(image.shape, dtype=np.uint8, buffer=self.slots[index].buf), image)
+            self.connections[index].send(('frame', image.shape))
+            status, reply = self.connections[index].recv()
+        except (EOFError, OSError) as e:
+            # The worker process is gone, restart it for the next frames or take it out of rotation.
+            alive = self._respawn(index)
+            if not alive:
+                with self.lock:
+                    self.workers_alive -= 1
+                    if not self.workers_alive:
+                        self.free.put(None)
+            raise RuntimeError(f'cpu worker {index} died{", restarted it" if alive else ""}') from e
+        finally:
+            if alive:
+                self.free.put(index)
+        if status == 'error':
+            raise RuntimeError(f'cpu worker {index} failed to process the frame, reason: {reply}')
+        result, preprocess, invoke, postprocess = reply
+        if timings is not None:
+            timings.record('preprocess', preprocess)
+            timings.record('invoke', invoke)
+            timings.record('postprocess', postprocess)
+        return result, invoke
+
+    def draw(self, image, result, latency: float):
+        """ Draws a decoded result and the model info on an image.
+        :param image: The BGR image, it is drawn on in place where possible.
+        :param result: The decoded result.
+        :param latency: The invoke duration in seconds.
+        :return: The image.
+        """
+        from coral_cam import Engine, InferenceAdaptor
+
+        return InferenceAdaptor.draw(Engine(None, self.inference_type, self.model_path, None, self.options), image,
+                                     result, latency, self.input_size)
+
+    def close(self):
+        """ Stops the workers and frees the shared memory.
+        :return: None
+        """
+        for conn in self.connections:
+            if conn is None:
+                continue
+            try:
+                conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(2.0)
+            if process.is_alive():
+                process.terminate()
+        for slot in self.slots:
+            if slot is not None:
+                slot.close()
+                slot.unlink()
+        self.slots = [None] * len(self.slots)
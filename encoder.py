@@ -0,0 +1,186 @@
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+# libjpeg-turbo bindings are optional, they beat cv2.imencode on OpenCV builds using plain libjpeg (e.g. the Dev Board).
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+BACKENDS = ('auto', 'simplejpeg', 'turbojpeg', 'opencv')
+MIN_QUALITY = 40  # Adaptive mode never goes below this quality...
+QUALITY_STEP = 10
+MIN_SCALES = (0.75, 0.5)  # ...and then shrinks the output by these factors.
+
+
+class JpegEncoder:
+    """
+    Encodes frames into JPEG at a configurable output size and quality, resizing into a reused buffer. In adaptive
+    mode it trades quality, then resolution, for speed whenever encoding eats too much of the frame budget or viewers
+    start skipping frames, and climbs back once there is headroom again.
+    """
+
+    def __init__(self, quality: int = 80, width: int = None, height: int = None, adaptive: bool = False,
+                 target_fps: float = None, backend: str = 'auto', adapt_interval: int = 30):
+        """
+        :param quality: The JPEG quality in [1, 100], the upper bound in adaptive mode.
+        :param width: The output width, None keeps the frame width, or scales it along with the height.
+        :param height: The output height, None keeps the frame height, or scales it along with the width.
+        :param adaptive: Whether to lower quality and resolution when falling behind.
+        :param target_fps: The frame rate adaptive mode tries to keep up with, None only reacts to skipped frames.
+        :param backend: One of BACKENDS, 'auto' picks the fastest one available.
+        :param adapt_interval: The number of frames between adaptive decisions.
+        """
+        self.backend, self.turbojpeg = JpegEncoder.load_backend(backend)
+        self.quality = quality
+        self.width = width
+        self.height = height
+        self.adaptive = adaptive
+        self.target_fps = target_fps
+        self.adapt_interval = adapt_interval
+        self.levels = JpegEncoder.adaptive_levels(quality)  # (scale, quality) pairs from best to fastest.
+        self.level = 0
+        self.lag_source = None  # Optional callable returning how many frames viewers have skipped so far.
+        self.last_lag = 0
+        self.frames = 0
+        self.busy = 0.0  # Seconds spent encoding since the last adaptive decision.
+        self.resized = None  # Reused resize buffer.
+
+    @staticmethod
+    def load_backend(backend: str):
+        """ Resolves an encoder backend.
+        :param backend: One of BACKENDS.
+        :return: The backend name and a TurboJPEG handle if that backend was picked.
+        :except: ValueError: If the backend is unknown or its module isn't installed.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown JPEG backend {backend}, expected one of {", ".join(BACKENDS)}')
+        if backend in ('auto', 'simplejpeg') and simplejpeg is not None:
+            return 'simplejpeg', None
+        if backend in ('auto', 'turbojpeg') and TurboJPEG is not None:
+            try:
+                return 'turbojpeg', TurboJPEG()
+            except (OSError, RuntimeError):
+                # PyTurboJPEG is installed but the libjpeg-turbo shared library isn't.
+                if backend == 'turbojpeg':
+                    raise
+        if backend not in ('auto', 'opencv'):
+            raise ValueError(f'The {backend} JPEG backend is not installed')
+        return 'opencv', None
+
+    @staticmethod
+    def adaptive_levels(quality: int):
+        """ Works out the settings adaptive mode steps through.
+        :param quality: The best quality.
+        :return: A list of (scale, quality) pairs from best to fastest.
+        """
+        levels = [(1.0, q) for q in range(quality, MIN_QUALITY, -QUALITY_STEP)]
+        floor = min(quality, MIN_QUALITY)
+        levels.append((1.0, floor))
+        levels += [(scale, floor) for scale in MIN_SCALES]
+        return levels
+
+    def configure(self, quality: int = None, width: int = None, height: int = None, adaptive: bool = None,
+                  target_fps: float = None):
+        """ Changes the encoding settings, arguments left as None are kept.
+        :param quality: The JPEG quality in [1, 100].
+        :param width: The output width, 0 keeps the frame width.
+        :param height: The output height, 0 keeps the frame height.
+        :param adaptive: Whether to lower quality and resolution when falling behind.
+        :param target_fps: The frame rate adaptive mode tries to keep up with, 0 only reacts to skipped frames.
+        :return: None
+        """
+        if quality is not None:
+            self.quality = int(min(max(quality, 1), 100))
+            self.levels = JpegEncoder.adaptive_levels(self.quality)
+            self.level = 0
+        if width is not None:
+            self.width = width or None
+        if height is not None:
+            self.height = height or None
+        if adaptive is not None:
+            self.adaptive = adaptive
+            self.level = 0
+        if target_fps is not None:
+            self.target_fps = target_fps or None
+
+    def current_settings(self):
+        """ :return: The (scale, quality) currently used, scale applies on top of the configured output size. """
+        if not self.adaptive:
+            return 1.0, self.quality
+        return self.levels[self.level]
+
+    def output_size(self, frame_width: int, frame_height: int, scale: float = 1.0):
+        """ Works out the size frames are encoded at.
+        :param frame_width: The width of the frame.
+        :param frame_height: The height of the frame.
+        :param scale: The adaptive scale.
+        :return: The (width, height) of the encoded image.
+        """
+        width, height = self.width, self.height
+        if width and not height:
+            height = round(frame_height * width / frame_width)
+        elif height and not width:
+            width = round(frame_width * height / frame_height)
+        elif not width:
+            width, height = frame_width, frame_height
+        return max(int(width * scale), 1), max(int(height * scale), 1)
+
+    def resize(self, image, size: tuple):
+        """ Resizes an image into the reused buffer.
+        :param image: The BGR image.
+        :param size: The (width, height) to resize to.
+        :return: The resized image, the image itself if it already has that size.
+        """
+        width, height = size
+        if image.shape[1] == width and image.shape[0] == height:
+            return image
+        if self.resized is None or self.resized.shape != (height, width, 3):
+            self.resized = np.empty((height, width, 3), dtype=np.uint8)
+        # Shrinking with INTER_AREA avoids aliasing and is as cheap as INTER_LINEAR at these ratios.
+        cv2.resize(image, size, dst=self.resized, interpolation=cv2.INTER_AREA)
+        return self.resized
+
+    def encode(self, image):
+        """ Encodes an image into JPEG with the current settings.
+        :param image: The BGR image.
+        :return: The JPEG bytes, or None if encoding failed.
+        """
+        t0 = perf_counter()
+        scale, quality = self.current_settings()
+        image = self.resize(image, self.output_size(image.shape[1], image.shape[0], scale))
+        if self.backend == 'simplejpeg':
+            data = simplejpeg.encode_jpeg(np.ascontiguousarray(image), quality=quality, colorspace='BGR',
+                                           colorsubsampling='420')
+        elif self.backend == 'turbojpeg':
+            data = self.turbojpeg.encode(image, quality=quality)
+        else:
+            ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            data = jpeg.tobytes() if ret else None
+        if self.adaptive:
+            self.busy += perf_counter() - t0
+            self.frames += 1
+            if self.frames >= self.adapt_interval:
+                self.adapt()
+        return data
+
+    def adapt(self):
+        """ Steps adaptive mode up or down based on the frames encoded since the last call.
+        :return: None
+        """
+        mean = self.busy / self.frames
+        lag = self.lag_source() if self.lag_source is not None else 0
+        skipped = lag - self.last_lag
+        self.last_lag, self.busy, self.frames = lag, 0.0, 0
+        budget = 1.0 / self.target_fps if self.target_fps else None
+        # Encoding shares the frame budget with capture and inference, it should not take more than half of it.
+        if skipped > 0 or (budget is not None and mean > budget / 2):
+            self.level = min(self.level + 1, len(self.levels) - 1)
+        elif budget is None or mean < budget / 4:
+            self.level = max(self.level - 1, 0)
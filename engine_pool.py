@@ -0,0 +1,218 @@
+import os
+import threading
+from collections import OrderedDict
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+import numpy as np
+from tflite_runtime.interpreter import Interpreter
+from tflite_runtime.interpreter import load_delegate
+
+EDGETPU_SHARED_LIB = 'libedgetpu.so.1'
+POSENET_SHARED_LIB = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'posenet_lib', os.uname().machine, 'posenet_decoder.so')
+
+
+class ColdStart(NamedTuple):
+    """ How long an interpreter took to become ready, in milliseconds. """
+    model_path: str
+    edgetpu: bool
+    load_ms: float  # Loading the delegates and parsing the model.
+    allocate_ms: float
+    first_invoke_ms: Optional[float]  # Includes delegate init and uploading the model to the tpu, None without warm-up.
+    steady_invoke_ms: Optional[float]  # The median of the other warm-up invokes, None if there was only one.
+    warmup_runs: int
+
+
+def synthetic_input(detail: dict, rng: np.random.Generator):
+    """ Random data spanning the range of an input tensor, so warm-up runs take the same paths real frames do.
+    :param detail: The input details of the tensor.
+    :param rng: The random generator.
+    :return: The array.
+    """
+    dtype = np.dtype(detail['dtype'])
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return rng.integers(info.min, info.max, detail['shape'], dtype=dtype, endpoint=True)
+    return rng.uniform(-1.0, 1.0, detail['shape']).astype(dtype)
+
+
+class InterpreterPool:
+    """
+    A bounded LRU cache of interpreters that are ready to invoke, keyed by (model path, edgetpu, delegate set). Delegate
+    handles are loaded once and shared by every interpreter, so switching back to a recently used model costs a dict
+    lookup instead of a delegate load, a model parse and a tensor allocation.
+    """
+
+    def __init__(self, max_entries: int = 4, memory_budget: int = 256 * 1024 * 1024, cpu_threads: int = None,
+                 warmup_runs: int = 3):
+        """
+        :param max_entries: The maximum number of interpreters to keep around.
+        :param memory_budget: The maximum estimated memory in bytes the cached interpreters may use.
+        :param cpu_threads: The number of threads cpu interpreters run ops on, every core if None.
+        :param warmup_runs: The number of invokes on synthetic input before an interpreter is handed out, with 0 the
+        first frame pays for delegate init and the upload to the tpu.
+        """
+        self.max_entries = max_entries
+        self.memory_budget = memory_budget
+        self.cpu_threads = cpu_threads or os.cpu_count() or 1
+        self.warmup_runs = warmup_runs
+        self.cold_starts = {}  # (model path, edgetpu) -> ColdStart of the last interpreter built for it.
+        self.on_cold_start = None  # Optional callable invoked with the ColdStart of every interpreter built.
+        self.entries = OrderedDict()  # key -> (interpreter, estimated size in bytes), least recently used first.
+        self.delegates = {}  # shared library path -> delegate handle.
+        self.pending = {}  # key -> threading.Event for interpreters that are being built.
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def delegate_libs(model_path: str, edgetpu: bool):
+        """ Get the delegates a model needs.
+        :param model_path: The path to the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :return: A tuple of shared library paths.
+        """
+        libs = []
+        if edgetpu:
+            libs.append(EDGETPU_SHARED_LIB)
+        # Only look at the file name, the directories above it could be called anything.
+        if 'posenet' in os.path.basename(model_path):
+            libs.append(POSENET_SHARED_LIB)
+        return tuple(libs)
+
+    @staticmethod
+    def key(model_path: str, edgetpu: bool):
+        """ Get the cache key of a model.
+        :param model_path: The path to the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :return: The (model path, edgetpu, delegate set) key.
+        """
+        return model_path, edgetpu, InterpreterPool.delegate_libs(model_path, edgetpu)
+
+    def load_delegate(self, library: str):
+        """ Loads a delegate once and hands out the same handle afterwards.
+        :param library: The path to the delegate shared library.
+        :return: The delegate.
+        """
+        with self.lock:
+            if library not in self.delegates:
+                self.delegates[library] = load_delegate(library)
+            return self.delegates[library]
+
+    def get(self, model_path: str, edgetpu: bool, warmup_runs: int = None):
+        """ Get an allocated interpreter for a model, building and warming it up if it isn't cached.
+        :param model_path: The path to the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param warmup_runs: The number of warm-up invokes if the interpreter gets built, the warmup_runs attribute if
+        None.
+        :return: The interpreter.
+        """
+        key = self.key(model_path, edgetpu)
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key][0]
+                pending = self.pending.get(key)
+                if pending is None:
+                    self.pending[key] = threading.Event()
+                    break
+            # Someone else is building this interpreter already, wait for them instead of building it twice.
+            pending.wait()
+        try:
+            interpreter = self._build(key, self.warmup_runs if warmup_runs is None else warmup_runs)
+            self._insert(key, interpreter)
+            return interpreter
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    def warm_up(self, model_path: str, edgetpu: bool, on_error=None, warmup_runs: int = None):
+        """ Builds and warms up an interpreter on a background thread, so a later get() is a cache hit.
+        :param model_path: The path to the model.
+        :param edgetpu: Whether to use the edgetpu or not.
+        :param on_error: Optional callback invoked with the exception if the interpreter could not be built.
+        :param warmup_runs: The number of warm-up invokes, the warmup_runs attribute if None.
+        :return: The background thread.
+        """
+
+        def run():
+            try:
+                self.get(model_path, edgetpu, warmup_runs)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+
+        thread = threading.Thread(target=run, name='coral-cam-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def contains(self, model_path: str, edgetpu: bool):
+        """ :return: Whether an interpreter for the model is cached. """
+        with self.lock:
+            return self.key(model_path, edgetpu) in self.entries
+
+    def clear(self):
+        """ Drops every cached interpreter, the shared delegates are kept.
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def cold_start_stats(self):
+        """ :return: The ColdStart of every model an interpreter was built for, in build order. """
+        with self.lock:
+            return list(self.cold_starts.values())
+
+    def memory_usage(self):
+        """ :return: The estimated memory in bytes used by the cached interpreters. """
+        with self.lock:
+            return sum(size for _, size in self.entries.values())
+
+    def _build(self, key, warmup_runs: int):
+        model_path, edgetpu, libs = key
+        t0 = perf_counter()
+        delegates = [self.load_delegate(lib) for lib in libs]
+        # Ops of edgetpu models all run on the tpu, only cpu models benefit from more threads.
+        num_threads = None if edgetpu else self.cpu_threads
+        if delegates:
+            interpreter = Interpreter(model_path, experimental_delegates=delegates, num_threads=num_threads)
+        else:
+            interpreter = Interpreter(model_path, num_threads=num_threads)
+        t1 = perf_counter()
+        interpreter.allocate_tensors()
+        t2 = perf_counter()
+        # The first invoke pays for delegate init and for uploading the model to the tpu, get that out of the way so it
+        # doesn't land on the first live frame. The later runs tell how fast the model is once warm.
+        rng = np.random.default_rng(0)
+        invokes = []
+        for _ in range(warmup_runs):
+            for detail in interpreter.get_input_details():
+                interpreter.set_tensor(detail['index'], synthetic_input(detail, rng))
+            t3 = perf_counter()
+            interpreter.invoke()
+            invokes.append((perf_counter() - t3) * 1000)
+        cold_start = ColdStart(model_path, edgetpu, (t1 - t0) * 1000, (t2 - t1) * 1000, invokes[0] if invokes else None,
+                               float(np.median(invokes[1:])) if len(invokes) > 1 else None, len(invokes))
+        with self.lock:
+            self.cold_starts.pop((model_path, edgetpu), None)
+            self.cold_starts[(model_path, edgetpu)] = cold_start
+        if self.on_cold_start is not None:
+            self.on_cold_start(cold_start)
+        return interpreter
+
+    @staticmethod
+    def _estimate_size(model_path: str, interpreter):
+        tensor_bytes = 0
+        for detail in interpreter.get_tensor_details():
+            tensor_bytes += int(np.prod(detail['shape'])) * np.dtype(detail['dtype']).itemsize
+        return os.path.getsize(model_path) + tensor_bytes
+
+    def _insert(self, key, interpreter):
+        size = self._estimate_size(key[0], interpreter)
+        with self.lock:
+            self.entries[key] = (interpreter, size)
+            self.entries.move_to_end(key)
+            # Evict least recently used interpreters, but always keep the one that was just asked for.
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or
+                                             sum(s for _, s in self.entries.values()) > self.memory_budget):
+                self.entries.popitem(last=False)
@@ -1,12 +1,51 @@
+import argparse
+import json
 import os
 import sys
-from tkinter import Tk, messagebox
+from time import perf_counter
 import eel
-import base64
 from coral_cam import CoralCam
+from metrics import process_uptime
+from model_utils import ModelUtils
+from streaming import FrameBroadcaster, FrameProducer, MJPEG_CONTENT_TYPE
 
-# Coral Cam is a global singleton
+STREAM_PATH = '/video_feed.mjpg'
+STARTUP_BUDGET = 3.0  # Seconds from process start until the server is about to start, see --startup-budget.
+import_time = perf_counter()  # Fallback start time where the process start time is unknown.
+
+# Coral Cam is a global singleton, the camera is only opened once the first frame is asked for.
 coral_cam = CoralCam()
+# Stream name -> (FrameBroadcaster, FrameProducer), every viewer of a stream shares the frames published to it.
+feeds = {}
+# The models --compare runs on every frame, the UI leaves them running rather than switching to its selected model.
+compare_models = None
+
+
+def add_feed(name: str):
+    """ Creates the broadcaster and producer that serve a stream of coral cam to viewers.
+    :param name: The name of the stream.
+    :return: The FrameBroadcaster of the stream.
+    """
+    feed_broadcaster = FrameBroadcaster()
+    # Adaptive encoding backs off when viewers of the stream start skipping frames.
+    coral_cam.stream(name).encoder.lag_source = lambda: feed_broadcaster.dropped
+    feeds[name] = (feed_broadcaster, FrameProducer(lambda: coral_cam.get_frame(name), feed_broadcaster))
+    return feed_broadcaster
+
+
+def collect_feed_metrics():
+    """ Reports the viewers and transport drops of every stream, see Metrics.add_collector(). """
+    samples = []
+    for name, (feed_broadcaster, _) in list(feeds.items()):
+        samples += [('gauge', 'viewers', {'stream': name}, feed_broadcaster.viewers),
+                    ('counter', 'frames_dropped_total', {'stream': name, 'queue': 'transport'},
+                     feed_broadcaster.dropped)]
+    return samples
+
+
+broadcaster = add_feed('default')
+producer = feeds['default'][1]
+coral_cam.metrics.add_collector(collect_feed_metrics)
 
 
 def show_error(title: str, msg: str):
@@ -15,6 +54,8 @@ def show_error(title: str, msg: str):
     :param msg: The actual error message.
     :return: None
     """
+    # Tk is only needed when something went wrong, don't pay for importing it on every start.
+    from tkinter import Tk, messagebox
     root = Tk()
     root.withdraw()  # hide main window
     messagebox.showerror(title, msg)
@@ -23,34 +64,279 @@ def show_error(title: str, msg: str):
 
 @eel.expose
 def video_feed():
-    """ The main program loop that gets exposes to javascript and updates coral-cam-video-feed. Internally it calls
-    coral_cam.get_frame() in order to get the frame that's already been preprocessed and then updates it to the image
-    tag.
-    :return: None
+    """ Starts the video feed that gets exposed to javascript. A background thread calls coral_cam.get_frame() to get
+    frames that have already been processed and publishes them, the browser then points coral-cam-video-feed at the
+    returned MJPEG stream.
+    :return: The path of the MJPEG stream.
+    """
+    producer.start()
+    return STREAM_PATH
+
+
+@eel.btl.route(STREAM_PATH)
+def mjpeg_stream():
+    """ Serves the video feed as binary multipart JPEG, every viewer only ever gets the latest frame.
+    :return: The stream body.
+    """
+    # Viewers like VLC or a second tab open the stream without going through video_feed() first.
+    producer.start()
+    eel.btl.response.content_type = MJPEG_CONTENT_TYPE
+    eel.btl.response.set_header('Cache-Control', 'no-cache, no-store')
+    # The stream is served by eel's gevent server, so wait for frames cooperatively.
+    return broadcaster.mjpeg_stream(sleep=eel.sleep,
+                                    on_sent=lambda seconds: coral_cam.stream().timings.record('transport', seconds))
+
+
+@eel.btl.route('/stream/<name>.mjpg')
+def named_mjpeg_stream(name: str):
+    """ Serves a named stream as binary multipart JPEG, see mjpeg_stream().
+    :param name: The name of the stream.
+    :return: The stream body.
+    """
+    if name not in feeds:
+        eel.btl.abort(404, f'No stream named {name}')
+    feed_broadcaster, feed_producer = feeds[name]
+    feed_producer.start()
+    eel.btl.response.content_type = MJPEG_CONTENT_TYPE
+    eel.btl.response.set_header('Cache-Control', 'no-cache, no-store')
+    timings = coral_cam.stream(name).timings
+    return feed_broadcaster.mjpeg_stream(sleep=eel.sleep, on_sent=lambda seconds: timings.record('transport', seconds))
+
+
+@eel.btl.route('/metrics')
+def prometheus_metrics():
+    """ Serves every metric in the Prometheus text exposition format.
+    :return: The metrics.
     """
-    while True:
-        frame = coral_cam.get_frame()
-        if frame is not None:
-            # Convert bytes to base64 encoded str, as we can only pass json to frontend
-            blob = base64.b64encode(frame).decode('utf-8')
-            eel.updateImageSrc(blob)()
+    eel.btl.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return coral_cam.metrics.render_prometheus()
 
 
 @eel.expose
-def set_engine(inference_type: str, model: str, edgetpu: bool):
+def set_engine(inference_type: str, model: str, edgetpu: bool, score_threshold: float = 0.5,
+               max_detections: int = None, segmentation_alpha: float = None,
+               pose_score_threshold: float = 0.2, keypoint_score_threshold: float = 0.5):
     """ Switch inference mode, model and toggle the edgetpu on/off when the submit button is clicked.
     :param inference_type: The type of inference ['classification', 'detection', 'pose-estimation', 'segmentation']
     :param model: The name of the model that user selected.
     :param edgetpu: Where to toggle the edgetpu on or off.
+    :param score_threshold: Detections scoring at or below this are dropped.
+    :param max_detections: Keep at most this many detections, None keeps all.
+    :param segmentation_alpha: Opacity of the segmentation mask over the camera image, None replaces the image.
+    :param pose_score_threshold: Poses scoring at or below this are dropped.
+    :param keypoint_score_threshold: Keypoints scoring at or below this are not drawn.
+    :return: None
+    """
+    coral_cam.set_engine(inference_type, model, edgetpu, score_threshold, max_detections, segmentation_alpha,
+                         pose_score_threshold, keypoint_score_threshold)
+
+
+@eel.expose
+def set_models(models: list, edgetpu: bool, layout: str = 'side-by-side', score_threshold: float = 0.5,
+               max_detections: int = None, segmentation_alpha: float = None,
+               pose_score_threshold: float = 0.2, keypoint_score_threshold: float = 0.5):
+    """ Run several models on every frame, e.g. to compare them.
+    :param models: The names of the models.
+    :param edgetpu: Where to toggle the edgetpu on or off.
+    :param layout: 'side-by-side' or 'composite'.
+    :param score_threshold: Detections scoring at or below this are dropped.
+    :param max_detections: Keep at most this many detections, None keeps all.
+    :param segmentation_alpha: Opacity of the segmentation mask over the camera image, None replaces the image.
+    :param pose_score_threshold: Poses scoring at or below this are dropped.
+    :param keypoint_score_threshold: Keypoints scoring at or below this are not drawn.
+    :return: None
+    """
+    coral_cam.set_models(models, edgetpu, layout, score_threshold, max_detections, segmentation_alpha,
+                         pose_score_threshold, keypoint_score_threshold)
+
+
+@eel.expose
+def get_compare_models():
+    """ Get the models started with --compare, so the UI doesn't replace them with its selected model on load.
+    :return: The names of the models, or None without --compare.
+    """
+    return compare_models
+
+
+@eel.expose
+def set_temporal_reuse(enabled: bool, threshold: float = 3.0, keyframe_interval: int = 30, smoothing: float = 0.5):
+    """ Skip inference on frames that barely changed, reusing the last result.
+    :param enabled: Whether to skip inference on static frames.
+    :param threshold: The frame difference, in gray levels, at or below which the last result is reused.
+    :param keyframe_interval: Inference runs at least once every this many frames.
+    :param smoothing: The weight of a new detection or pose against the previous one, 1 disables smoothing.
+    :return: None
+    """
+    coral_cam.set_temporal_reuse(enabled, threshold, keyframe_interval, smoothing)
+
+
+@eel.expose
+def set_encoding(quality: int = None, width: int = None, height: int = None, adaptive: bool = None):
+    """ Change the JPEG quality and output size of the video feed.
+    :param quality: The JPEG quality in [1, 100].
+    :param width: The output width, 0 keeps the camera width.
+    :param height: The output height, 0 keeps the camera height.
+    :param adaptive: Whether to lower quality and resolution when encoding or viewers fall behind.
+    :return: None
+    """
+    coral_cam.set_encoding(quality, width, height, adaptive)
+
+
+@eel.expose
+def prewarm_model(model: str, edgetpu: bool):
+    """ Build the interpreter of a model in the background when the user selects it, so that submitting is instant.
+    :param model: The name of the model that user selected.
+    :param edgetpu: Where to toggle the edgetpu on or off.
     :return: None
     """
-    coral_cam.set_engine(inference_type, model, edgetpu)
+    coral_cam.prewarm(model, edgetpu)
+
+
+@eel.expose
+def get_cold_starts():
+    """ Get how long every model built so far took to load, allocate and invoke cold and warm.
+    :return: See CoralCam.get_cold_starts().
+    """
+    return coral_cam.get_cold_starts()
+
+
+@eel.expose
+def list_streams():
+    """ Get every stream along with the path it is served at.
+    :return: See CoralCam.list_streams(), with a 'path' added to each stream.
+    """
+    streams = coral_cam.list_streams()
+    for stream in streams:
+        stream['path'] = STREAM_PATH if stream['name'] == 'default' else f'/stream/{stream["name"]}.mjpg'
+    return streams
+
+
+@eel.expose
+def get_available_models():
+    """ Get the models found on disk, so the UI can tell which ones can be used.
+    :return: See ModelUtils.available_models().
+    """
+    return ModelUtils.available_models()
+
+
+@eel.expose
+def get_metrics():
+    """ Get every metric, so the UI can poll them.
+    :return: See CoralCam.get_metrics().
+    """
+    return coral_cam.get_metrics()
+
+
+@eel.expose
+def get_stage_timings():
+    """ Get the per stage durations of the video feed, so the UI can show which stage limits throughput.
+    :return: See CoralCam.get_stage_timings().
+    """
+    return coral_cam.get_stage_timings()
+
+
+def parse_args():
+    """ Parses the command line arguments.
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Coral Cam')
+    parser.add_argument('--source', default='0',
+                        help='Camera index, video file/url, directory of images or "synthetic" (default: camera 0).')
+    parser.add_argument('--capture-width', type=int, default=1280, help='Width to request from the camera.')
+    parser.add_argument('--capture-height', type=int, default=720, help='Height to request from the camera.')
+    parser.add_argument('--fourcc', default=None,
+                        help='Pixel format to request from the camera, e.g. MJPG (more fps over USB) or YUYV.')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Run capture, inference and encoding concurrently on separate threads.')
+    parser.add_argument('--queue-size', type=int, default=1,
+                        help='Frames each pipeline stage may queue before the oldest is dropped.')
+    parser.add_argument('--max-fps', type=float, default=None,
+                        help='Cap on the number of frames per second sent to viewers.')
+    parser.add_argument('--cpu-threads', type=int, default=None,
+                        help='Threads cpu models run ops on when the edgetpu is off (default: one per core).')
+    parser.add_argument('--cpu-workers', type=int, default=0,
+                        help='Run cpu models in this many worker processes when the edgetpu is off, needs --pipelined.')
+    parser.add_argument('--compare', nargs='+', default=None, metavar='MODEL',
+                        help='Run these models on every frame instead of the one selected in the UI.')
+    parser.add_argument('--layout', choices=['side-by-side', 'composite'], default='side-by-side',
+                        help='How the results of --compare are shown (default: side-by-side).')
+    parser.add_argument('--cpu', action='store_true',
+                        help='Run the --compare models and build the --prewarm models without the edgetpu.')
+    parser.add_argument('--prewarm', nargs='+', default=None, metavar='MODEL',
+                        help='Build and warm up these models in the background at startup, so switching to them is '
+                             'instant. The pool keeps the 4 most recently used.')
+    parser.add_argument('--warmup-runs', type=int, default=3, choices=range(0, 101), metavar='{0..100}',
+                        help='Invokes on synthetic input before a new interpreter is used, the first one pays for '
+                             'delegate init and the upload to the tpu. 0 leaves that to the first frame (default: 3).')
+    parser.add_argument('--reuse-threshold', type=float, default=None,
+                        help='Reuse the last result for frames whose difference to the last inferred frame, in gray '
+                             'levels, is at or below this (default: run inference on every frame).')
+    parser.add_argument('--keyframe-interval', type=int, default=30,
+                        help='With --reuse-threshold, run inference at least once every this many frames.')
+    parser.add_argument('--smoothing', type=float, default=0.5,
+                        help='With --reuse-threshold, the weight of a new detection or pose against the previous one.')
+    parser.add_argument('--jpeg-quality', type=int, default=80, help='JPEG quality of the video feed in [1, 100].')
+    parser.add_argument('--output-width', type=int, default=0,
+                        help='Width of the video feed, 0 keeps the camera width (the height follows if unset).')
+    parser.add_argument('--output-height', type=int, default=0,
+                        help='Height of the video feed, 0 keeps the camera height (the width follows if unset).')
+    parser.add_argument('--adaptive-encoding', action='store_true',
+                        help='Lower JPEG quality, then resolution, whenever encoding or viewers fall behind.')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET,
+                        help='Warn when starting up takes longer than this many seconds.')
+    parser.add_argument('--streams', default=None,
+                        help='A JSON file listing extra streams, each an object with a name, a source and optionally '
+                             'an inference_type, model, edgetpu flag and fps target.')
+    args = parser.parse_args()
+    if args.cpu_workers > 1 and not args.pipelined:
+        # Serial mode hands the workers one frame at a time, that is a shared memory copy and a round trip for nothing.
+        parser.error('--cpu-workers needs --pipelined, only the pipeline keeps several workers busy at once')
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.source != '0' or args.fourcc or (args.capture_width, args.capture_height) != (1280, 720):
+        coral_cam.set_source(args.source, width=args.capture_width, height=args.capture_height, fourcc=args.fourcc)
+    if args.cpu_threads:
+        coral_cam.pool.cpu_threads = args.cpu_threads
+    coral_cam.cpu_workers = args.cpu_workers
+    coral_cam.pool.warmup_runs = args.warmup_runs
+    for model_name in args.prewarm or []:
+        if model_name in ModelUtils.available_models():
+            coral_cam.prewarm(model_name, not args.cpu)
+        else:
+            print(f'Warning: can not prewarm {model_name}, it was not found in test_data')
+    if args.compare:
+        compare_models = args.compare
+        coral_cam.set_models(args.compare, not args.cpu, args.layout)
+    if args.pipelined:
+        coral_cam.start_pipeline(args.queue_size)
+    if args.streams:
+        with open(args.streams) as f:
+            for spec in json.load(f):
+                spec = dict(spec)
+                name = spec.pop('name')
+                coral_cam.add_stream(name, spec.pop('source'), pipelined=True, **spec)
+                add_feed(name)
+    for name, (_, feed_producer) in feeds.items():
+        if args.max_fps:
+            feed_producer.min_interval = 1.0 / args.max_fps
+        coral_cam.set_encoding(args.jpeg_quality, args.output_width, args.output_height, args.adaptive_encoding,
+                               args.max_fps or coral_cam.stream(name).fps or 0, stream=name)
+        if args.reuse_threshold is not None:
+            coral_cam.set_temporal_reuse(True, args.reuse_threshold, args.keyframe_interval, args.smoothing, name)
     try:
         curr_path = os.path.dirname(os.path.abspath(__file__))
         eel.init(os.path.join(curr_path, 'web'))
+        coral_cam.forward_log()
+        startup_time = process_uptime()
+        if startup_time is None:
+            startup_time = perf_counter() - import_time
+        coral_cam.metrics.set('startup_seconds', startup_time)
+        print(f'Started up in {startup_time:.2f} s')
+        if startup_time > args.startup_budget:
+            print(f'Warning: starting up took longer than the {args.startup_budget:.2f} s budget')
         host = '0.0.0.0'
         port = 8888
         print(f'Starting CoralCam @ {host}:{port}')
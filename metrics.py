@@ -0,0 +1,311 @@
+import os
+import resource
+import threading
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+
+# Histogram bucket upper bounds in seconds, from sub-millisecond preprocessing up to multi-second engine switches.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def percentile(samples, q: float):
+    """ Nearest-rank percentile of a sequence of samples.
+    :param samples: The samples, need not be sorted.
+    :param q: The percentile in [0, 100].
+    :return: The percentile, or 0.0 if there are no samples.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = int(round(q / 100.0 * (len(ordered) - 1)))
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class Histogram:
+    """ A cumulative histogram with fixed buckets, cheap enough to update on every frame. """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        :param buckets: The sorted bucket upper bounds, an implicit +Inf bucket is added.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """ Adds one observation.
+        :param value: The observed value.
+        :return: None
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ :return: A list of (upper bound, cumulative count) pairs, the last upper bound is float('inf'). """
+        pairs, running = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            running += count
+            pairs.append((bound, running))
+        return pairs
+
+
+class StageStats:
+    """ Keeps a rolling window of durations for a single pipeline stage, plus a histogram of every duration. """
+
+    def __init__(self, window: int = 300):
+        """
+        :param window: The number of most recent samples to keep.
+        """
+        self.samples = deque(maxlen=window)
+        self.stamps = deque(maxlen=window)  # When each sample was recorded, to work out the actual frame rate.
+        self.histogram = Histogram()
+        self.count = 0
+
+    def record(self, seconds: float):
+        """ Records one duration.
+        :param seconds: The duration in seconds.
+        :return: None
+        """
+        self.samples.append(seconds)
+        self.stamps.append(perf_counter())
+        self.histogram.observe(seconds)
+        self.count += 1
+
+    def summary(self):
+        """ Summarizes the current window.
+        :return: A dict with count, mean/p50/p95/p99/max in milliseconds, the throughput this stage alone could
+        sustain and the rate it actually ran at, both in frames per second.
+        """
+        samples = list(self.samples)
+        if not samples:
+            return {'count': self.count, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0,
+                    'max_fps': 0.0, 'rate_fps': 0.0}
+        mean = sum(samples) / len(samples)
+        stamps = list(self.stamps)
+        elapsed = stamps[-1] - stamps[0] if len(stamps) > 1 else 0.0
+        return {
+            'count': self.count,
+            'mean_ms': mean * 1000,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+            'max_ms': max(samples) * 1000,
+            'max_fps': 1.0 / mean if mean > 0 else 0.0,
+            'rate_fps': (len(stamps) - 1) / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class StageTimings:
+    """ A thread safe collection of StageStats keyed by stage name. """
+    # Stages that are timed but are not part of processing a frame, they can't limit the frame rate.
+    non_frame_stages = {'engine_switch', 'latency', 'source_open'}
+    # Stages timing several other stages at once, they would always come out on top of the stages they are made of.
+    aggregate_stages = {'inference': ('preprocess', 'invoke', 'postprocess', 'annotate')}
+
+    def __init__(self, window: int = 300):
+        self.window = window
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        """ Records one duration for a stage, creating the stage on first use.
+        :param stage: The stage name, e.g. 'capture', 'inference' or 'encode'.
+        :param seconds: The duration in seconds.
+        :return: None
+        """
+        stats = self.stages.get(stage)
+        if stats is None:
+            with self.lock:
+                stats = self.stages.setdefault(stage, StageStats(self.window))
+        stats.record(seconds)
+
+    def time(self, stage: str):
+        """ Context manager that records the duration of its body under a stage name.
+        :param stage: The stage name.
+        :return: The context manager.
+        """
+        return _StageTimer(self, stage)
+
+    def summary(self):
+        """ Summarizes every stage.
+        :return: A dict of stage name to StageStats.summary().
+        """
+        return {stage: stats.summary() for stage, stats in list(self.stages.items())}
+
+    def bottleneck(self):
+        """ Finds the stage that limits throughput.
+        :return: The name of the stage with the highest mean duration, or None if nothing was recorded. Aggregate
+        stages like inference only compete when none of their parts were timed.
+        """
+        summary = {stage: stats for stage, stats in self.summary().items() if stage not in self.non_frame_stages}
+        for stage, parts in self.aggregate_stages.items():
+            if any(part in summary for part in parts):
+                summary.pop(stage, None)
+        if not summary:
+            return None
+        return max(summary, key=lambda stage: summary[stage]['mean_ms'])
+
+
+class _StageTimer:
+    def __init__(self, timings: StageTimings, stage: str):
+        self.timings = timings
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.record(self.stage, perf_counter() - self.start)
+        return False
+
+
+def resident_memory_bytes():
+    """ Get the resident set size of the process.
+    :return: The RSS in bytes, the peak RSS on platforms without /proc.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_uptime():
+    """ Get how long the process has been running, including the time spent importing modules.
+    :return: The seconds since the process started, or None on platforms without /proc.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The process name may contain spaces, the fields after it are space separated.
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _format_labels(labels: dict):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """
+    The metrics of a running coral cam: per stage durations, counters and gauges. Every stream records its stage
+    durations apart, so the streams don't blur each other's percentiles and bottleneck. Counters and gauges that other
+    objects already keep track of (queue depths, dropped frames) are pulled from collectors when the metrics are read,
+    so the hot path only pays for stage timings.
+    """
+    prefix = 'coral_cam'
+
+    def __init__(self, timings: StageTimings = None):
+        """
+        :param timings: The stage timings that belong to no stream, a new StageTimings is created if None.
+        """
+        self.timings = timings if timings is not None else StageTimings()
+        self.stream_timings = {}  # Stream name -> StageTimings, see add_stream_timings().
+        self.counters = {}  # (name, sorted label items) -> value
+        self.gauges = {}  # (name, sorted label items) -> value
+        self.collectors = []  # Callables returning an iterable of (kind, name, labels, value).
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """ Increments a counter.
+        :param name: The counter name, without the prefix.
+        :param value: The increment.
+        :param labels: The counter labels.
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """ Sets a gauge.
+        :param name: The gauge name, without the prefix.
+        :param value: The value.
+        :param labels: The gauge labels.
+        :return: None
+        """
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add_stream_timings(self, stream: str):
+        """ Creates the stage timings of a stream, they are exposed with a stream label.
+        :param stream: The name of the stream.
+        :return: The new StageTimings, replacing any previous one of the stream.
+        """
+        timings = self.stream_timings[stream] = StageTimings(self.timings.window)
+        return timings
+
+    def remove_stream_timings(self, stream: str):
+        """ Stops exposing the stage timings of a stream.
+        :param stream: The name of the stream.
+        :return: None
+        """
+        self.stream_timings.pop(stream, None)
+
+    def add_collector(self, collector):
+        """ Registers a callable that is asked for extra samples whenever the metrics are read.
+        :param collector: Returns an iterable of (kind, name, labels, value) with kind 'counter' or 'gauge'.
+        :return: None
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        """ Gathers every counter and gauge.
+        :return: A list of (kind, name, labels, value).
+        """
+        with self.lock:
+            samples = [('counter', name, dict(labels), value) for (name, labels), value in self.counters.items()]
+        samples += [('gauge', name, dict(labels), value) for (name, labels), value in list(self.gauges.items())]
+        for collector in list(self.collectors):
+            samples += list(collector())
+        samples.append(('gauge', 'process_resident_memory_bytes', {}, resident_memory_bytes()))
+        return samples
+
+    def snapshot(self, stream: str = None):
+        """ A JSON friendly view of the metrics for the UI.
+        :param stream: The stream to summarize the stages of, the stages that belong to no stream if None.
+        :return: A dict with the stage summaries, the bottleneck stage, and the counters and gauges.
+        """
+        samples = {}
+        for kind, name, labels, value in self.collect():
+            samples[name + _format_labels(labels)] = value
+        timings = self.timings if stream is None else self.stream_timings.get(stream, StageTimings())
+        return {'stages': timings.summary(), 'bottleneck': timings.bottleneck(), 'samples': samples}
+
+    def render_prometheus(self):
+        """ Renders the metrics in the Prometheus text exposition format.
+        :return: The text.
+        """
+        lines = []
+        stage_metric = f'{self.prefix}_stage_seconds'
+        lines.append(f'# HELP {stage_metric} Duration of each stage of the video feed.')
+        lines.append(f'# TYPE {stage_metric} histogram')
+        labelled = [({}, self.timings)] + [({'stream': stream}, timings)
+                                           for stream, timings in sorted(self.stream_timings.items())]
+        for labels, timings in labelled:
+            for stage, stats in sorted(timings.stages.items()):
+                histogram = stats.histogram
+                stage_labels = dict(labels, stage=stage)
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{stage_metric}_bucket{_format_labels(dict(stage_labels, le=le))} {count}')
+                lines.append(f'{stage_metric}_sum{_format_labels(stage_labels)} {histogram.sum}')
+                lines.append(f'{stage_metric}_count{_format_labels(stage_labels)} {histogram.count}')
+
+        typed = set()
+        for kind, name, labels, value in sorted(self.collect(), key=lambda sample: sample[1]):
+            metric = f'{self.prefix}_{name}'
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} {kind}')
+                typed.add(metric)
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
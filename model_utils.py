@@ -1,12 +1,19 @@
 import os
+from functools import lru_cache
+
 import numpy as np
 
+# Models, labels and delegates are found relative to the package rather than the working directory.
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(PACKAGE_DIR, 'test_data')
+
 
+@lru_cache(maxsize=None)
 def read_detection_label():
-    """ Reads coco label into a map.
+    """ Reads coco label into a map, once.
     :return: The Coco label map.
     """
-    coco_label_path = os.path.join('test_data', 'coco_labels.txt')
+    coco_label_path = os.path.join(MODEL_DIR, 'coco_labels.txt')
     with open(coco_label_path, 'r', encoding='utf-8') as f:
         lines = f.readlines()
         if not lines:
@@ -18,17 +25,19 @@ def read_detection_label():
             return {index: line.strip() for index, line in enumerate(lines)}
 
 
+@lru_cache(maxsize=None)
 def read_classification_label():
-    """ Reads imagenet label into a list.
+    """ Reads imagenet label into a list, once.
     :return: The imagenet label map.
     """
-    imagenet_label_path = os.path.join('test_data', 'imagenet_labels.txt')
+    imagenet_label_path = os.path.join(MODEL_DIR, 'imagenet_labels.txt')
     with open(imagenet_label_path, 'r') as f:
         return [line.strip() for line in f.readlines()]
 
 
+@lru_cache(maxsize=None)
 def create_pascal_label_colormap():
-    """ Creates a label colormap used in PASCAL VOC segmentation benchmark.
+    """ Creates a label colormap used in PASCAL VOC segmentation benchmark, once.
       :return: A Colormap for visualizing segmentation results.
     """
     colormap = np.zeros((256, 3), dtype=int)
@@ -37,9 +46,35 @@ def create_pascal_label_colormap():
         for channel in range(3):
             colormap[:, channel] |= ((indices >> channel) & 1) << shift
         indices >>= 3
+    colormap.flags.writeable = False  # Shared by every caller.
     return colormap
 
 
+@lru_cache(maxsize=None)
+def create_segmentation_bgr_lut():
+    """ Creates the PASCAL colormap as a (256, 3) BGR uint8 lookup table, ready to index with a label mask, once.
+    :return: The lookup table.
+    """
+    lut = np.ascontiguousarray(create_pascal_label_colormap()[:, ::-1], dtype=np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def guess_inference_type(file_name: str):
+    """ Guesses what a model that isn't in the catalog is for from its file name.
+    :param file_name: The model file name.
+    :return: The inference type ['classification', 'detection', 'pose-estimation', 'segmentation'].
+    """
+    name = file_name.lower()
+    if 'posenet' in name or 'movenet' in name:
+        return 'pose-estimation'
+    if 'deeplab' in name or 'segment' in name:
+        return 'segmentation'
+    if 'ssd' in name or 'det' in name:
+        return 'detection'
+    return 'classification'
+
+
 class ModelUtils:
     model_name_to_path = {
         'MobileNet V1 (0.5 depth mul. 160x160)': os.path.join('test_data', 'mobilenet_v1_0.5_160_quant_edgetpu.tflite'),
@@ -78,21 +113,75 @@ class ModelUtils:
                                                                 'deeplabv3_mnv2_pascal_quant_edgetpu.tflite')
     }
 
-    detection_label = read_detection_label()
-    classification_label = read_classification_label()
-    segmentation_pascal_color_map = create_pascal_label_colormap()
+    inference_type_to_model_names = {
+        'classification': ['MobileNet V1 (0.5 depth mul. 160x160)', 'MobileNet V1 (0.25 depth mul. 128x128)',
+                           'MobileNet V1 (0.75 depth mul. 192x192)', 'MobileNet V1 (1.0 depth mul. 224x224)',
+                           'MobileNet V2 (1.0 depth mul. 224x224)', 'Inception V1', 'Inception V2', 'Inception V3',
+                           'Inception V4', 'ResNet-50', 'EfficientNet (224x224)', 'EfficientNet (240x240)',
+                           'EfficientNet (300x300)'],
+        'detection': ['SSD MobileNet V1', 'SSD MobileNet V2', 'SSDLite MobileDet', 'EfficientDet-Lite0',
+                      'EfficientDet-Lite1', 'EfficientDet-Lite2', 'EfficientDet-Lite3'],
+        'pose-estimation': ['PoseNet MobileNet V1 (353x481)', 'PoseNet MobileNet V1 (481x641)',
+                            'PoseNet MobileNet V1 (721x1281)', 'MoveNet.SinglePose.Lightning',
+                            'MoveNet.SinglePose.Thunder'],
+        'segmentation': ['MobileNet V2 DeepLab V3 (0.5 depth mul)', 'MobileNet V2 DeepLab V3 (1.0 depth mul)']
+    }
 
     @staticmethod
     def get_model_path(model_name: str, edgetpu=True):
         """ Get the model path to a model name that is selected by the user.
         :param model_name: The name of the model selected by the user.
         :param edgetpu: Whether to use the edgetpu or not.
-        :return:
+        :return: The absolute path to the model.
         """
+        path = ModelUtils.model_name_to_path.get(model_name)
+        if path is None:
+            path = ModelUtils.available_models()[model_name]['path']
+        path = os.path.join(PACKAGE_DIR, path)
         if edgetpu:
-            return ModelUtils.model_name_to_path[model_name]
+            return path
         else:
-            return ModelUtils.model_name_to_path[model_name].replace('_edgetpu', '')
+            return path.replace('_edgetpu', '')
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def available_models():
+        """ Scans the model directory for edgetpu models and their cpu twins, once. Models missing from the catalog
+        are listed under their file name.
+        :return: A dict of model name to {'path', 'inference_type', 'edgetpu', 'cpu'}, the path is relative to the
+        package and points at the edgetpu model.
+        """
+        path_to_name = {path: name for name, path in ModelUtils.model_name_to_path.items()}
+        models = {}
+        for directory, _, file_names in os.walk(MODEL_DIR):
+            for file_name in sorted(file_names):
+                if not file_name.endswith('_edgetpu.tflite'):
+                    continue
+                path = os.path.relpath(os.path.join(directory, file_name), PACKAGE_DIR)
+                name = path_to_name.get(path, file_name[:-len('_edgetpu.tflite')])
+                cpu_path = os.path.join(directory, file_name.replace('_edgetpu', ''))
+                models[name] = {'path': path, 'edgetpu': True, 'cpu': os.path.exists(cpu_path),
+                                'inference_type': ModelUtils.get_inference_type(name)
+                                if name in path_to_name.values() else guess_inference_type(file_name)}
+        # cpu models whose edgetpu twin is missing are still usable with the edgetpu off.
+        for name, path in ModelUtils.model_name_to_path.items():
+            if name not in models and os.path.exists(os.path.join(PACKAGE_DIR, path.replace('_edgetpu', ''))):
+                models[name] = {'path': path, 'edgetpu': False, 'cpu': True,
+                                'inference_type': ModelUtils.get_inference_type(name)}
+        return models
+
+    @staticmethod
+    def get_inference_type(model_name: str):
+        """ Get the inference type a model is meant for.
+        :param model_name: The name of the model.
+        :return: The inference type ['classification', 'detection', 'pose-estimation', 'segmentation'].
+        """
+        for inference_type, model_names in ModelUtils.inference_type_to_model_names.items():
+            if model_name in model_names:
+                return inference_type
+        if model_name in ModelUtils.available_models():
+            return ModelUtils.available_models()[model_name]['inference_type']
+        raise KeyError(f'Unknown model: {model_name}')
 
     @staticmethod
     def get_detection_class(key: int):
@@ -100,7 +189,7 @@ class ModelUtils:
         :param key: The key to coco label map.
         :return: The name of the class.
         """
-        return ModelUtils.detection_label[key]
+        return read_detection_label()[key]
 
     @staticmethod
     def get_classification_class(key: int):
@@ -108,7 +197,14 @@ class ModelUtils:
         :param key: The index into the imagemet label map.
         :return: The name of the class.
         """
-        return ModelUtils.classification_label[key]
+        return read_classification_label()[key]
+
+    @staticmethod
+    def segmentation_bgr_lut():
+        """ Get the PASCAL colormap as a (256, 3) BGR uint8 lookup table.
+        :return: The lookup table.
+        """
+        return create_segmentation_bgr_lut()
 
     @staticmethod
     def label_to_color_image(label: np.array):
@@ -121,7 +217,8 @@ class ModelUtils:
         if label.ndim != 2:
             raise ValueError('Expect 2-D input label')
 
-        if np.max(label) >= len(ModelUtils.segmentation_pascal_color_map):
+        colormap = create_pascal_label_colormap()
+        if np.max(label) >= len(colormap):
             raise ValueError('label value too large.')
 
-        return ModelUtils.segmentation_pascal_color_map[label]
+        return colormap[label]
@@ -0,0 +1,284 @@
+import threading
+import traceback
+from collections import deque
+from time import perf_counter, sleep, time
+from typing import Callable, Optional
+
+from metrics import StageTimings
+from sources import Frame, FrameSource
+
+
+class LatestQueue:
+    """ A bounded, thread safe FIFO that drops its oldest item instead of blocking when full. """
+
+    def __init__(self, maxsize: int = 1):
+        """
+        :param maxsize: The maximum number of items to hold, older items are dropped to make room.
+        """
+        self.maxsize = max(1, maxsize)
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0  # Number of items dropped because a consumer fell behind.
+
+    def put(self, item):
+        """ Adds an item, dropping the oldest one if the queue is full.
+        :param item: The item.
+        :return: None
+        """
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout: float = None):
+        """ Removes and returns the oldest item, waiting for one if needed.
+        :param timeout: The maximum number of seconds to wait, None to wait forever.
+        :return: The item, or None on timeout or once the queue is closed and drained.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.closed, timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            # Wake up a producer waiting for room as well as the other consumers.
+            self.cond.notify_all()
+            return item
+
+    def wait_for_room(self, timeout: float = None):
+        """ Waits until an item can be added without dropping the oldest one.
+        :param timeout: The maximum number of seconds to wait, None to wait forever.
+        :return: Whether there is room, False on timeout or once the queue is closed.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.items) < self.maxsize or self.closed, timeout)
+            return not self.closed and len(self.items) < self.maxsize
+
+    def close(self):
+        """ Wakes up every consumer, get() returns None once the remaining items are drained. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Pipeline:
+    """
+    Runs capture, inference and encoding on three threads linked by LatestQueues, so the camera, the tpu and the jpeg
+    encoder can all work on different frames at the same time. Stale frames are dropped rather than queued so the
+    output always trails the camera by as little as possible. When several pipelines share an InferenceScheduler, the
+    scheduler runs their inference stage instead of a thread of their own. Backends that run inference outside of the
+    GIL, like a pool of worker processes, can be fed by several inference threads, their results are handed to the
+    encode stage in capture order.
+    """
+
+    def __init__(self, source: FrameSource, process: Callable, encode: Callable, queue_size: int = 1,
+                 timings: StageTimings = None, on_frame: Callable = None, scheduler=None, fps: float = None,
+                 inference_workers: int = 1):
+        """
+        :param source: Where to pull frames from.
+        :param process: Called with a BGR image, returns the annotated image.
+        :param encode: Called with the annotated image, returns the encoded bytes or None.
+        :param queue_size: How many frames each queue holds before dropping the oldest.
+        :param timings: Where to record per stage durations, a new StageTimings is created if None.
+        :param on_frame: Optional callback invoked with every encoded Frame.
+        :param scheduler: Optional InferenceScheduler to run the inference stage on.
+        :param fps: Optional target frame rate, frames are not processed more often than this.
+        :param inference_workers: The number of threads running the inference stage when there is no scheduler.
+        """
+        self.source = source
+        self.process = process
+        self.encode = encode
+        self.timings = timings if timings is not None else StageTimings()
+        self.on_frame = on_frame
+        self.scheduler = scheduler
+        self.min_interval = 1.0 / fps if fps else 0.0
+        self.next_due = 0.0  # perf_counter() time before which the next frame should not be processed.
+        self.inference_workers = inference_workers
+        self.reorder_lock = threading.Lock()
+        self.in_flight = set()  # Seqs of the frames being processed.
+        self.done = {}  # seq -> processed Frame waiting for older frames to finish.
+        self.last_emitted = 0  # Seq of the last frame handed to the encode stage.
+        self.workers_left = 0  # Inference threads that haven't exited yet, the last one closes the encode queue.
+        self.capture_queue = LatestQueue(queue_size)
+        self.encode_queue = LatestQueue(queue_size)
+        self.latest = None  # The most recent encoded Frame.
+        self.latest_cond = threading.Condition()
+        self.running = False
+        self.finished = threading.Event()  # Set once a finite source has been fully processed.
+        self.threads = []
+
+    def start(self):
+        """ Starts the capture, inference and encode threads.
+        :return: None
+        """
+        if self.running:
+            return
+        self.running = True
+        self.finished.clear()
+        self.capture_queue = LatestQueue(self.capture_queue.maxsize)
+        self.encode_queue = LatestQueue(self.encode_queue.maxsize)
+        self.in_flight, self.done, self.last_emitted = set(), {}, 0
+        stages = [('capture', self._capture_loop), ('encode', self._encode_loop)]
+        if self.scheduler is None:
+            self.workers_left = max(self.inference_workers, 1)
+            stages += [('inference', self._inference_loop)] * self.workers_left
+        self.threads = [threading.Thread(target=target, name=f'coral-cam-{name}', daemon=True)
+                        for name, target in stages]
+        for thread in self.threads:
+            thread.start()
+        if self.scheduler is not None:
+            self.scheduler.register(self)
+
+    def stop(self, timeout: float = 2.0):
+        """ Stops every thread and waits for them to exit.
+        :param timeout: The maximum number of seconds to wait for each thread.
+        :return: None
+        """
+        self.running = False
+        if self.scheduler is not None:
+            self.scheduler.unregister(self)
+        self.capture_queue.close()
+        self.encode_queue.close()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def wait_for_frame(self, after_seq: int = 0, timeout: float = None) -> Optional[Frame]:
+        """ Waits for an encoded frame newer than after_seq.
+        :param after_seq: The sequence number of the last frame the caller has seen.
+        :param timeout: The maximum number of seconds to wait, None to wait forever.
+        :return: The newest encoded Frame, or None on timeout or once the pipeline is finished.
+        """
+        with self.latest_cond:
+            self.latest_cond.wait_for(
+                lambda: (self.latest is not None and self.latest.seq > after_seq) or self.finished.is_set(), timeout)
+            if self.latest is not None and self.latest.seq > after_seq:
+                return self.latest
+            return None
+
+    def dropped_frames(self):
+        """ :return: The number of frames dropped by each queue because the next stage fell behind. """
+        return {'capture': self.capture_queue.dropped, 'encode': self.encode_queue.dropped}
+
+    def set_fps(self, fps: float = None):
+        """ Changes the target frame rate.
+        :param fps: The target frame rate, None to process frames as fast as possible.
+        :return: None
+        """
+        self.min_interval = 1.0 / fps if fps else 0.0
+        self.next_due = 0.0
+
+    def run_inference(self, frame: Frame):
+        """ Runs the inference stage on a captured frame and hands the result to the encode stage.
+        :param frame: The captured Frame.
+        :return: None
+        """
+        t0 = perf_counter()
+        self.next_due = t0 + self.min_interval
+        with self.reorder_lock:
+            self.in_flight.add(frame.seq)
+        processed = None
+        try:
+            processed = Frame(frame.seq, frame.timestamp, self.process(frame.image))
+            self.timings.record('inference', perf_counter() - t0)
+        finally:
+            self._emit(frame.seq, processed)
+
+    def _emit(self, seq: int, processed: Optional[Frame]):
+        """ Hands processed frames to the encode stage in capture order, once every older frame is done.
+        :param seq: The seq of the frame that is done.
+        :param processed: The processed Frame, None if processing failed.
+        :return: None
+        """
+        with self.reorder_lock:
+            self.in_flight.discard(seq)
+            if processed is not None:
+                self.done[seq] = processed
+            oldest = min(self.in_flight, default=None)
+            for ready in sorted(self.done):
+                if oldest is not None and ready > oldest:
+                    break
+                frame = self.done.pop(ready)
+                # A frame that was overtaken before it even started is stale, never go back in time.
+                if ready > self.last_emitted:
+                    self.last_emitted = ready
+                    self.encode_queue.put(frame)
+
+    def _capture_loop(self):
+        live = getattr(self.source, 'live', False)
+        source_fps = getattr(self.source, 'fps', None)
+        next_read = perf_counter()
+        while self.running:
+            if not live:
+                # Files and folders could be read as fast as they decode, but the frames would only be dropped. Play
+                # them at their own frame rate or the target one, and otherwise only read once there is room.
+                interval = 1.0 / source_fps if source_fps else self.min_interval
+                if interval:
+                    now = perf_counter()
+                    if next_read > now:
+                        sleep(next_read - now)
+                    next_read = max(next_read, now) + interval
+                elif not self.capture_queue.wait_for_room():
+                    continue
+            t0 = perf_counter()
+            frame = self.source.read()
+            if frame is None:
+                if live:
+                    sleep(0.01)
+                    continue
+                break
+            self.timings.record('capture', perf_counter() - t0)
+            self.capture_queue.put(frame)
+            if self.scheduler is not None:
+                self.scheduler.notify()
+        self.capture_queue.close()
+        if self.scheduler is not None:
+            self.scheduler.notify()
+
+    def _inference_loop(self):
+        while True:
+            # Wait until the next frame is due before taking one, so the frame processed is the freshest one.
+            due_in = self.next_due - perf_counter()
+            if due_in > 0:
+                sleep(due_in)
+            frame = self.capture_queue.get()
+            if frame is None or not self.running:
+                # Once stopped, leave the frames still queued alone, the process callable may be about to change.
+                break
+            try:
+                self.run_inference(frame)
+            except Exception:
+                # Like the scheduler, keep going, a dead inference thread would stall the pipeline for good.
+                traceback.print_exc()
+        with self.reorder_lock:
+            self.workers_left -= 1
+            last = self.workers_left == 0
+        if last:
+            self.encode_queue.close()
+
+    def _encode_loop(self):
+        while True:
+            frame = self.encode_queue.get()
+            if frame is None:
+                break
+            t0 = perf_counter()
+            data = self.encode(frame.image)
+            self.timings.record('encode', perf_counter() - t0)
+            if data is None:
+                continue
+            # From the moment the frame was captured until it is ready to be sent.
+            self.timings.record('latency', time() - frame.timestamp)
+            encoded = Frame(frame.seq, frame.timestamp, data)
+            with self.latest_cond:
+                self.latest = encoded
+                self.latest_cond.notify_all()
+            if self.on_frame is not None:
+                self.on_frame(encoded)
+        with self.latest_cond:
+            self.finished.set()
+            self.latest_cond.notify_all()
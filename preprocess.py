@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+import tflite_runtime.interpreter
+
+
+class PreprocessPlan:
+    """
+    Everything needed to turn a BGR frame into the input tensor of an interpreter, worked out once per engine. Frames
+    are resized into a reused scratch buffer and colour converted straight into the interpreter's input buffer, so
+    the per frame path does not allocate.
+    """
+
+    def __init__(self, interpreter: tflite_runtime.interpreter.Interpreter, interpolation: int = cv2.INTER_LINEAR):
+        """
+        :param interpreter: The allocated tflite interpreter.
+        :param interpolation: The cv2 interpolation used to resize frames to the model input size.
+        """
+        input_details = interpreter.get_input_details()[0]
+        self.index = input_details['index']
+        self.shape = tuple(input_details['shape'])  # (batch, height, width, channels)
+        self.height, self.width = int(self.shape[1]), int(self.shape[2])
+        self.dtype = input_details['dtype']
+        self.quantization = input_details['quantization']  # (scale, zero_point)
+        self.interpolation = interpolation
+        # A callable returning a view of the input buffer. The view must not outlive the call to fill(), the
+        # interpreter refuses to invoke while anyone holds a reference to its internal buffers.
+        self.input_tensor = interpreter.tensor(self.index)
+        # Output tensor indices in output order, so decoding doesn't query the output details on every frame.
+        self.output_indices = [details['index'] for details in interpreter.get_output_details()]
+        self.resized = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        # uint8 models get converted straight into the input buffer, others need an intermediate rgb buffer.
+        self.rgb = None if self.dtype == np.uint8 else np.empty_like(self.resized)
+
+    def fill(self, image: np.ndarray):
+        """ Resizes and colour converts a BGR image straight into the interpreter's input buffer.
+        :param image: The BGR image.
+        :return: None
+        """
+        cv2.resize(image, (self.width, self.height), dst=self.resized, interpolation=self.interpolation)
+        self.convert(self.resized, self.input_tensor()[0])
+
+    def convert(self, resized: np.ndarray, out: np.ndarray):
+        """ Colour converts a BGR image that is already at the model input size into an input buffer.
+        :param resized: The BGR image at the model input size.
+        :param out: Where to write the model input, e.g. a view of the interpreter's input buffer.
+        :return: None
+        """
+        if self.dtype == np.uint8:
+            cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=out)
+        elif self.dtype == np.int8:
+            cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=self.rgb)
+            # Flipping the top bit maps uint8 [0, 255] onto int8 [-128, 127], i.e. x - 128, without a temporary.
+            np.bitwise_xor(self.rgb, 128, out=out.view(np.uint8))
+        else:
+            cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=self.rgb)
+            np.multiply(self.rgb, np.float32(1.0 / 128.0), out=out, dtype=np.float32)
+            np.subtract(out, np.float32(1.0), out=out)
@@ -0,0 +1,265 @@
+import argparse
+import gzip
+import json
+import queue
+import sys
+import threading
+from time import perf_counter
+
+import cv2
+
+from coral_cam import InferenceAdaptor
+from engine_pool import InterpreterPool
+from model_utils import ModelUtils
+from preprocess import PreprocessPlan
+from results import result_from_dict, result_to_dict
+from sources import open_source
+
+
+class VideoRecorder:
+    """
+    Writes frames to a video file on a background thread, so encoding the video doesn't slow down the loop producing the
+    frames. The writer is opened with the size of the first frame. Frames are written in the order they are handed in,
+    write() blocks once queue_size frames are waiting rather than dropping any.
+    """
+
+    def __init__(self, path: str, fps: float = 30.0, fourcc: str = 'mp4v', queue_size: int = 8):
+        """
+        :param path: The video file to write.
+        :param fps: The frame rate stored in the file.
+        :param fourcc: The codec, e.g. 'mp4v' or 'MJPG'.
+        :param queue_size: The number of frames that can wait to be written.
+        """
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.queue = queue.Queue(queue_size)
+        self.writer = None
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='coral-cam-recorder', daemon=True)
+        self.thread.start()
+
+    def write(self, image):
+        """ Queues a frame, the recorder owns it from now on so don't draw on it anymore.
+        :param image: The BGR image.
+        :return: None
+        :except: RuntimeError: If the video file could not be written.
+        """
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        self.queue.put(image)
+
+    def _run(self):
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            if self.error is not None:
+                continue
+            if self.writer is None:
+                height, width = image.shape[:2]
+                self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps,
+                                              (width, height))
+                if not self.writer.isOpened():
+                    self.error = f'Could not open {self.path} for writing with the {self.fourcc} codec'
+                    continue
+            self.writer.write(image)
+            self.written += 1
+        if self.writer is not None:
+            self.writer.release()
+
+    def close(self):
+        """ Writes the frames still queued and closes the file.
+        :return: None
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class FrameTimings(dict):
+    """ Collects the stage durations of a single frame, in milliseconds, where a StageTimings is expected. """
+
+    def record(self, stage: str, seconds: float):
+        """ Records the duration of a stage.
+        :param stage: The stage name.
+        :param seconds: The duration in seconds.
+        :return: None
+        """
+        self[stage] = round(seconds * 1000, 3)
+
+
+def open_results(path: str, mode: str):
+    """ Opens a results file, gzip compressed if its name ends with .gz.
+    :param path: The path, '-' for stdin/stdout.
+    :param mode: 'r' or 'w'.
+    :return: The text file.
+    """
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def record(args):
+    """ Runs a model over a source and writes the annotated video and the results of every frame.
+    :param args: The parsed arguments of the record command.
+    :return: The exit code.
+    """
+    edgetpu = not args.cpu
+    model_path = ModelUtils.get_model_path(args.model, edgetpu)
+    inference_type = ModelUtils.get_inference_type(args.model)
+    options = dict(InferenceAdaptor.default_options, score_threshold=args.score_threshold,
+                   segmentation_alpha=args.segmentation_alpha, pose_score_threshold=args.pose_threshold,
+                   keypoint_score_threshold=args.keypoint_threshold)
+    interpreter = InterpreterPool(max_entries=1).get(model_path, edgetpu)
+    plan = PreprocessPlan(interpreter)
+
+    source = open_source(args.source)
+    video = VideoRecorder(args.video, args.fps, args.fourcc) if args.video else None
+    raw_video = VideoRecorder(args.raw_video, args.fps, args.fourcc) if args.raw_video else None
+    out = open_results(args.results, 'w')
+    frames = 0
+    start = perf_counter()
+    try:
+        header = {'type': 'header', 'model': args.model, 'model_path': model_path, 'inference_type': inference_type,
+                  'edgetpu': edgetpu, 'input_size': [plan.width, plan.height], 'source': str(args.source),
+                  'options': options}
+        out.write(json.dumps(header) + '\n')
+        while args.frames is None or frames < args.frames:
+            frame = source.read()
+            if frame is None:
+                if getattr(source, 'live', False):
+                    continue
+                break
+            if raw_video is not None:
+                # The annotations are drawn on the frame in place.
+                raw_video.write(frame.image.copy())
+            timings = FrameTimings()
+            t0 = perf_counter()
+            image, result = InferenceAdaptor.process(interpreter, frame.image, inference_type, model_path, plan,
+                                                     timings, options)
+            latency = perf_counter() - t0
+            if video is not None:
+                video.write(image)
+            # index counts the recorded frames, it is the position of the frame in --raw-video. seq comes from the
+            # source and skips the frames a camera dropped, it is only kept for information.
+            line = {'type': 'frame', 'index': frames, 'seq': frame.seq, 'timestamp': frame.timestamp,
+                    'latency_ms': round(latency * 1000, 3), 'timings': timings, 'result': result_to_dict(result)}
+            out.write(json.dumps(line) + '\n')
+            frames += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.release()
+        for recorder in (video, raw_video):
+            if recorder is not None:
+                recorder.close()
+        if out is not sys.stdout:
+            out.close()
+    elapsed = perf_counter() - start
+    print(f'Recorded {frames} frames in {elapsed:.1f} s ({frames / elapsed if elapsed > 0 else 0.0:.2f} fps)',
+          file=sys.stderr)
+    for recorder in (video, raw_video):
+        if recorder is not None and recorder.error is not None:
+            print(recorder.error, file=sys.stderr)
+            return 1
+    return 0
+
+
+def replay(args):
+    """ Draws recorded results over the footage they were recorded from, without running any model.
+    :param args: The parsed arguments of the replay command.
+    :return: The exit code.
+    """
+    source = open_source(args.footage)
+    video = VideoRecorder(args.output, args.fps, args.fourcc)
+    results = open_results(args.results, 'r')
+    frames = 0
+    try:
+        header = json.loads(results.readline())
+        if header.get('type') != 'header':
+            print(f'{args.results} does not start with a header line', file=sys.stderr)
+            return 1
+        inference_type = header['inference_type']
+        options = dict(InferenceAdaptor.default_options, **header['options'])
+        input_size = tuple(header['input_size'])
+        frame, index = source.read(), 0  # index is the position of frame in the footage.
+        for text in results:
+            line = json.loads(text)
+            if line.get('type') != 'frame':
+                continue
+            # Skip to the frame the result belongs to, results of frames missing from the footage are skipped.
+            while frame is not None and index < line['index']:
+                frame, index = source.read(), index + 1
+            if frame is None:
+                break
+            if index > line['index']:
+                continue
+            result = result_from_dict(line['result'])
+            image = InferenceAdaptor.draw_result(inference_type, frame.image, result, options)
+            latency = line['timings'].get('invoke', line['latency_ms'])
+            InferenceAdaptor.add_model_info(None, header['model_path'], f'latency: {latency:.2f} ms', image,
+                                            input_size=input_size)
+            video.write(image)
+            frames += 1
+            frame, index = source.read(), index + 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.release()
+        video.close()
+        if results is not sys.stdin:
+            results.close()
+    print(f'Replayed {frames} frames into {args.output}', file=sys.stderr)
+    if video.error is not None:
+        print(video.error, file=sys.stderr)
+        return 1
+    return 0
+
+
+def parse_args():
+    """ Parses the command line arguments.
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Record Coral Cam results headless, without eel or a display, and '
+                                                 'replay them over the footage without running the model again.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    recorder = commands.add_parser('record', help='Run a model over a camera or file and record what it sees.')
+    recorder.add_argument('source', help='A camera index, a directory of images, or a video path/url.')
+    recorder.add_argument('--model', required=True, help='The name of the model to run.')
+    recorder.add_argument('--cpu', action='store_true', help='Run the cpu model rather than the edgetpu one.')
+    recorder.add_argument('--results', default='-',
+                          help='Where to write the results as JSON Lines, gzip compressed if the name ends with .gz '
+                               '(default: stdout).')
+    recorder.add_argument('--video', default=None, help='Where to write the annotated video.')
+    recorder.add_argument('--raw-video', default=None,
+                          help='Where to write the video without annotations, to replay the results over later.')
+    recorder.add_argument('--frames', type=int, default=None, help='Stop after this many frames (default: never).')
+    recorder.add_argument('--score-threshold', type=float, default=0.5, help='Detections scoring below are dropped.')
+    recorder.add_argument('--segmentation-alpha', type=float, default=None,
+                          help='Blend segmentation masks over the frames with this opacity.')
+    recorder.add_argument('--pose-threshold', type=float, default=0.2, help='Poses scoring below are dropped.')
+    recorder.add_argument('--keypoint-threshold', type=float, default=0.5,
+                          help='Keypoints scoring below are not drawn.')
+
+    replayer = commands.add_parser('replay', help='Draw recorded results over the footage they came from.')
+    replayer.add_argument('footage', help='The raw video or directory of images the results were recorded from.')
+    replayer.add_argument('results', help='The JSON Lines results written by record.')
+    replayer.add_argument('--output', required=True, help='Where to write the annotated video.')
+
+    for command in (recorder, replayer):
+        command.add_argument('--fps', type=float, default=30.0, help='The frame rate of the written videos.')
+        command.add_argument('--fourcc', default='mp4v', help='The codec of the written videos (default: mp4v).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    return record(args) if args.command == 'record' else replay(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
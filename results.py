@@ -0,0 +1,87 @@
+import base64
+from typing import NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+
+class ClassificationResult(NamedTuple):
+    """ The top-1 class of a classification model. """
+    class_id: int
+    label: str
+    score: float
+
+
+class DetectionResult(NamedTuple):
+    """ The detections that passed the score threshold, boxes are (x_min, y_min, x_max, y_max) in image pixels. """
+    boxes: np.ndarray  # (N, 4) int32
+    classes: np.ndarray  # (N,) int32
+    scores: np.ndarray  # (N,) float32
+    labels: list  # N class names
+
+
+class PoseResult(NamedTuple):
+    """ The poses found in an image, keypoints are (x, y) in image pixels. """
+    keypoints: np.ndarray  # (num_poses, num_keypoints, 2)
+    keypoint_scores: Optional[np.ndarray]  # (num_poses, num_keypoints), None if the model doesn't provide them.
+    pose_scores: Optional[np.ndarray]  # (num_poses,), None if the model doesn't provide them.
+
+
+class SegmentationResult(NamedTuple):
+    """ The per pixel class labels at model resolution. """
+    mask: np.ndarray  # (height, width) uint8
+
+
+def _array(values, dtype, shape: tuple = None):
+    array = np.asarray(values if values is not None else [], dtype=dtype)
+    return array.reshape(shape) if shape is not None else array
+
+
+def _rounded(values, decimals: int):
+    # float32 values turn into long decimals once converted to float, round them as float64.
+    return None if values is None else np.round(np.asarray(values, dtype=np.float64), decimals).tolist()
+
+
+def result_to_dict(result):
+    """ Converts a result into plain lists and numbers, e.g. to write it as JSON.
+    :param result: A ClassificationResult, DetectionResult, PoseResult or SegmentationResult.
+    :return: The dict, its 'type' tells result_from_dict() what to rebuild.
+    """
+    if isinstance(result, ClassificationResult):
+        return {'type': 'classification', 'class_id': int(result.class_id), 'label': result.label,
+                'score': float(result.score)}
+    if isinstance(result, DetectionResult):
+        return {'type': 'detection', 'boxes': result.boxes.tolist(), 'classes': result.classes.tolist(),
+                'scores': _rounded(result.scores, 4), 'labels': list(result.labels)}
+    if isinstance(result, PoseResult):
+        return {'type': 'pose', 'keypoints': _rounded(result.keypoints, 1),
+                'keypoint_scores': _rounded(result.keypoint_scores, 4), 'pose_scores': _rounded(result.pose_scores, 4)}
+    if isinstance(result, SegmentationResult):
+        # A label mask is mostly runs of the same value, PNG keeps it small.
+        _, png = cv2.imencode('.png', result.mask)
+        return {'type': 'segmentation', 'mask_png': base64.b64encode(png.tobytes()).decode('ascii')}
+    raise TypeError(f'Unknown result type: {type(result).__name__}')
+
+
+def result_from_dict(data: dict):
+    """ Rebuilds a result converted by result_to_dict().
+    :param data: The dict.
+    :return: The result.
+    """
+    kind = data['type']
+    if kind == 'classification':
+        return ClassificationResult(data['class_id'], data['label'], data['score'])
+    if kind == 'detection':
+        return DetectionResult(_array(data['boxes'], np.int32, (-1, 4)), _array(data['classes'], np.int32),
+                               _array(data['scores'], np.float32), data['labels'])
+    if kind == 'pose':
+        keypoints = _array(data['keypoints'], np.float32)
+        if not keypoints.size:
+            keypoints = keypoints.reshape(0, 0, 2)
+        return PoseResult(keypoints,
+                          None if data['keypoint_scores'] is None else _array(data['keypoint_scores'], np.float32),
+                          None if data['pose_scores'] is None else _array(data['pose_scores'], np.float32))
+    if kind == 'segmentation':
+        png = np.frombuffer(base64.b64decode(data['mask_png']), dtype=np.uint8)
+        return SegmentationResult(cv2.imdecode(png, cv2.IMREAD_GRAYSCALE))
+    raise ValueError(f'Unknown result type: {kind}')
@@ -0,0 +1,107 @@
+import threading
+import traceback
+from time import perf_counter
+
+
+class InferenceScheduler:
+    """
+    Runs the inference stage of several pipelines on a single thread, so every stream shares the accelerator (and the
+    interpreters built for it) instead of competing for it. Pipelines with a frame waiting are served round-robin, and
+    a pipeline with an fps target is not served again before its next frame is due.
+    """
+
+    def __init__(self):
+        self.pipelines = []
+        self.cursor = 0  # Index of the pipeline to consider first on the next pick, for round-robin fairness.
+        self.cond = threading.Condition()
+        # Held around the preprocess, invoke and decode stages of every in-process engine, by whichever thread runs
+        # them, see Stream.process_frame(). Annotating runs outside of it.
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def register(self, pipeline):
+        """ Starts serving a pipeline, starting the scheduler thread if needed.
+        :param pipeline: The Pipeline.
+        :return: None
+        """
+        with self.cond:
+            if pipeline not in self.pipelines:
+                self.pipelines.append(pipeline)
+            if not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self._run, name='coral-cam-scheduler', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def unregister(self, pipeline):
+        """ Stops serving a pipeline.
+        :param pipeline: The Pipeline.
+        :return: None
+        """
+        with self.cond:
+            if pipeline in self.pipelines:
+                self.pipelines.remove(pipeline)
+            self.cond.notify()
+
+    def notify(self):
+        """ Wakes the scheduler up, pipelines call it whenever they have captured a frame.
+        :return: None
+        """
+        with self.cond:
+            self.cond.notify()
+
+    def stop(self):
+        """ Stops the scheduler thread.
+        :return: None
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(2.0)
+            self.thread = None
+
+    def _pick(self, now: float):
+        """ Picks the next pipeline to serve.
+        :param now: The current perf_counter() time.
+        :return: The pipeline to serve, or None along with how many seconds to wait before looking again.
+        """
+        wait = None
+        count = len(self.pipelines)
+        for offset in range(count):
+            index = (self.cursor + offset) % count
+            pipeline = self.pipelines[index]
+            if pipeline.capture_queue.closed and not len(pipeline.capture_queue):
+                return pipeline, 0.0
+            if not len(pipeline.capture_queue):
+                continue
+            due_in = pipeline.next_due - now
+            if due_in <= 0:
+                self.cursor = (index + 1) % count
+                return pipeline, 0.0
+            wait = due_in if wait is None else min(wait, due_in)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running:
+                        return
+                    pipeline, wait = self._pick(perf_counter())
+                    if pipeline is not None:
+                        break
+                    self.cond.wait(wait)
+            if pipeline.capture_queue.closed and not len(pipeline.capture_queue):
+                # The source of this pipeline is exhausted, let its encode stage drain and finish.
+                self.unregister(pipeline)
+                pipeline.encode_queue.close()
+                continue
+            frame = pipeline.capture_queue.get(timeout=0)
+            if frame is not None:
+                try:
+                    pipeline.run_inference(frame)
+                except Exception:
+                    # One broken stream must not stall the others sharing the scheduler.
+                    traceback.print_exc()
@@ -0,0 +1,249 @@
+import os
+import sys
+import threading
+from time import sleep, time
+from typing import NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class Frame(NamedTuple):
+    """ A captured frame along with its sequence number and capture timestamp (seconds since epoch). """
+    seq: int
+    timestamp: float
+    image: np.ndarray
+
+
+class FrameSource:
+    """
+    Base class for everything coral cam can pull frames from. Subclasses implement _read_image() and may override
+    release().
+    """
+    live = False  # Live sources may fail to deliver a frame now and then, finite ones are done once read() fails.
+    fps = None  # The frame rate finite sources were recorded at, None if unknown.
+
+    def __init__(self):
+        self.seq = 0  # Number of frames handed out so far.
+
+    def read(self) -> Optional[Frame]:
+        """ Reads the next frame from the source.
+        :return: The next Frame, or None if the source has no frame to offer.
+        """
+        image = self._read_image()
+        if image is None:
+            return None
+        self.seq += 1
+        return Frame(self.seq, time(), image)
+
+    def _read_image(self) -> Optional[np.ndarray]:
+        raise NotImplementedError
+
+    def release(self):
+        """ Releases any resource held by the source. """
+        pass
+
+
+class CaptureSource(FrameSource):
+    """ A cv2.VideoCapture backed source, used for camera device indices, video files and RTSP/HTTP urls. """
+
+    def __init__(self, target, width: int = None, height: int = None, loop: bool = False):
+        """
+        :param target: A device index or a path/url that cv2.VideoCapture can open.
+        :param width: The capture width to request, only meaningful for cameras.
+        :param height: The capture height to request, only meaningful for cameras.
+        :param loop: Whether to rewind to the first frame once the end of a file is reached.
+        """
+        super().__init__()
+        self.target = target
+        self.loop = loop
+        self.live = isinstance(target, int) or str(target).startswith(('rtsp://', 'http://', 'https://'))
+        self.video = cv2.VideoCapture(target)
+        if width:
+            self.video.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height:
+            self.video.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if not self.live:
+            self.fps = self.video.get(cv2.CAP_PROP_FPS) or None
+
+    def _read_image(self):
+        success, image = self.video.read()
+        if not success and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, image = self.video.read()
+        return image if success else None
+
+    def release(self):
+        self.video.release()
+
+
+class CameraSource(FrameSource):
+    """
+    Captures continuously on a background thread, so the driver never queues up stale frames, and always hands out the
+    newest frame. Frames are retrieved into a ring of preallocated buffers instead of a new array per frame. A buffer
+    is only reused once nothing but the ring refers to it, so consumers may keep and annotate frames for as long as
+    they like, holding on to more frames than the ring has only costs an allocation.
+    """
+    live = True
+
+    def __init__(self, target, width: int = None, height: int = None, fourcc: str = None, ring_size: int = 4):
+        """
+        :param target: A device index or a stream url that cv2.VideoCapture can open.
+        :param width: The capture width to request, a lower native resolution saves decoding and resizing.
+        :param height: The capture height to request.
+        :param fourcc: The pixel format to request, e.g. 'MJPG' to get more fps over USB or 'YUYV' to skip decoding.
+        :param ring_size: The number of frame buffers to cycle through.
+        """
+        super().__init__()
+        self.target = target
+        self.video = cv2.VideoCapture(target)
+        # The format has to be requested before the size, some drivers only offer large sizes in MJPG.
+        if fourcc:
+            self.video.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if width:
+            self.video.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height:
+            self.video.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        # Backends that support it keep a single frame queued, the grab thread keeps up with the camera anyway.
+        self.video.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.ring = [None] * ring_size
+        self.latest = None  # The newest Frame.
+        self.captured = 0  # Number of frames captured so far, the seq of the newest frame.
+        self.skipped = 0  # Frames captured but never handed out because a newer one came along.
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='coral-cam-camera', daemon=True)
+        self.thread.start()
+
+    def read(self, timeout: float = 1.0) -> Optional[Frame]:
+        """ Gets the newest frame, waiting for one if the newest was already handed out.
+        :param timeout: How many seconds to wait for a new frame.
+        :return: The Frame, its seq counts every captured frame so gaps are frames that were skipped. None if no new
+        frame was captured in time.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: not self.running or (self.latest is not None and
+                                                                   self.latest.seq != self.seq), timeout):
+                return None
+            frame = self.latest
+            if frame is None or frame.seq == self.seq:
+                return None
+            self.skipped += frame.seq - self.seq - 1
+            self.seq = frame.seq
+        return frame
+
+    def _free_slot(self, start: int):
+        """ Finds a ring buffer no consumer refers to anymore.
+        :param start: The slot to look at first.
+        :return: The slot index, or None if every buffer is in use.
+        """
+        for offset in range(len(self.ring)):
+            index = (start + offset) % len(self.ring)
+            # Only the ring and getrefcount's own argument refer to a free buffer, the latest frame keeps its buffer
+            # busy, and so do consumers holding the image or a view of it.
+            if self.ring[index] is None or sys.getrefcount(self.ring[index]) <= 2:
+                return index
+        return None
+
+    def _run(self):
+        index = 0
+        while self.running:
+            if not self.video.grab():
+                sleep(0.01)
+                continue
+            timestamp = time()
+            slot = self._free_slot(index)
+            if slot is None:
+                # Every buffer is held by a consumer, let retrieve() allocate a new one.
+                slot = index
+                self.ring[slot] = None
+            # retrieve() decodes straight into the buffer when its size and type match, else it allocates one.
+            success, image = self.video.retrieve(self.ring[slot])
+            if not success:
+                continue
+            self.ring[slot] = image
+            with self.cond:
+                self.captured += 1
+                self.latest = Frame(self.captured, timestamp, image)
+                self.cond.notify_all()
+            index = (slot + 1) % len(self.ring)
+            del image
+
+    def release(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        self.thread.join(2.0)
+        self.video.release()
+
+
+class ImageFolderSource(FrameSource):
+    """ Serves every image of a directory in lexicographic order. """
+
+    def __init__(self, directory: str, loop: bool = False):
+        """
+        :param directory: The directory to read images from.
+        :param loop: Whether to start over once every image has been served.
+        """
+        super().__init__()
+        self.paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.lower().endswith(IMAGE_EXTENSIONS))
+        self.loop = loop
+        self.index = 0
+
+    def _read_image(self):
+        if self.index >= len(self.paths):
+            if not self.loop or not self.paths:
+                return None
+            self.index = 0
+        image = cv2.imread(self.paths[self.index])
+        self.index += 1
+        return image
+
+
+class SyntheticSource(FrameSource):
+    """ Generates moving test pattern frames, handy when no camera or footage is around. """
+
+    def __init__(self, width: int = 1280, height: int = 720, num_frames: int = None):
+        """
+        :param width: The frame width.
+        :param height: The frame height.
+        :param num_frames: The number of frames to generate, None for an endless stream.
+        """
+        super().__init__()
+        self.num_frames = num_frames
+        gradient = np.linspace(0, 255, width, dtype=np.uint8)
+        self.background = np.dstack([np.tile(gradient, (height, 1))] * 3)
+
+    def _read_image(self):
+        if self.num_frames is not None and self.seq >= self.num_frames:
+            return None
+        image = np.roll(self.background, self.seq * 8, axis=1)
+        height, width = image.shape[:2]
+        x = (self.seq * 16) % width
+        cv2.rectangle(image, (x, height // 3), (x + width // 8, 2 * height // 3), (77, 94, 253), cv2.FILLED)
+        return image
+
+
+def open_source(spec, width: int = 1280, height: int = 720, loop: bool = False, fourcc: str = None) -> FrameSource:
+    """ Builds a frame source from a user supplied spec.
+    :param spec: A camera index (int or digit string), 'synthetic', a directory of images, or a video path/url.
+    :param width: The frame width to request from cameras and synthetic sources.
+    :param height: The frame height to request from cameras and synthetic sources.
+    :param loop: Whether file based sources should loop forever.
+    :param fourcc: The pixel format to request from cameras, e.g. 'MJPG' or 'YUYV'.
+    :return: The frame source.
+    """
+    if isinstance(spec, FrameSource):
+        return spec
+    if isinstance(spec, int) or (isinstance(spec, str) and spec.isdigit()):
+        return CameraSource(int(spec), width, height, fourcc)
+    if isinstance(spec, str) and spec.startswith(('rtsp://', 'http://', 'https://')):
+        return CameraSource(spec)
+    if spec == 'synthetic':
+        return SyntheticSource(width, height)
+    if os.path.isdir(spec):
+        return ImageFolderSource(spec, loop)
+    return CaptureSource(spec, loop=loop)
@@ -0,0 +1,120 @@
+import threading
+import traceback
+from time import sleep as time_sleep
+from time import perf_counter, time
+from typing import Callable, Optional
+
+from sources import Frame
+
+MJPEG_BOUNDARY = 'frame'
+MJPEG_CONTENT_TYPE = f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}'
+
+
+class FrameBroadcaster:
+    """
+    Holds the latest encoded frame and hands it out to any number of viewers. Every viewer gets the same bytes object,
+    so a frame is encoded once no matter how many browsers are watching, and a viewer that falls behind simply skips
+    to the newest frame instead of queueing up old ones.
+    """
+
+    def __init__(self):
+        self.frame = None  # The latest Frame, its image holds the encoded bytes.
+        self.seq = 0
+        self.viewers = 0  # Number of connected viewers.
+        self.dropped = 0  # Frames viewers skipped because they were too slow to receive them.
+        self.lock = threading.Lock()
+
+    def publish(self, data: bytes, timestamp: float = None):
+        """ Makes an encoded frame the latest one.
+        :param data: The encoded frame.
+        :param timestamp: The capture timestamp of the frame, now if None.
+        :return: None
+        """
+        with self.lock:
+            self.seq += 1
+            self.frame = Frame(self.seq, timestamp if timestamp is not None else time(), data)
+
+    def latest(self) -> Optional[Frame]:
+        """ :return: The latest Frame, or None if nothing has been published yet. """
+        return self.frame
+
+    def mjpeg_stream(self, sleep: Callable = time_sleep, poll_interval: float = 0.005, on_sent: Callable = None):
+        """ Generates a multipart/x-mixed-replace body that a browser can show in a plain img tag.
+        :param sleep: The function used to wait for the next frame, pass a cooperative sleep such as eel.sleep when
+        the generator is consumed by a gevent server.
+        :param poll_interval: How many seconds to wait between checks for a new frame.
+        :param on_sent: Optional callback invoked with the number of seconds it took to hand a frame to the viewer.
+        :return: A generator of bytes chunks.
+        """
+        header = f'--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+        last_seq = 0
+        with self.lock:
+            self.viewers += 1
+        try:
+            while True:
+                frame = self.frame
+                if frame is None or frame.seq == last_seq:
+                    sleep(poll_interval)
+                    continue
+                if last_seq and frame.seq > last_seq + 1:
+                    self.dropped += frame.seq - last_seq - 1
+                last_seq = frame.seq
+                # Yield the shared bytes object as is rather than concatenating it with the part header.
+                t0 = perf_counter()
+                yield (header % len(frame.image)).encode('ascii')
+                yield frame.image
+                yield b'\r\n'
+                # The server only asks for more once the previous chunks were written, so this is the send time.
+                if on_sent is not None:
+                    on_sent(perf_counter() - t0)
+        finally:
+            with self.lock:
+                self.viewers -= 1
+
+
+class FrameProducer:
+    """ Pulls frames from a callable on a background thread and publishes them to a FrameBroadcaster. """
+
+    def __init__(self, get_frame: Callable, broadcaster: FrameBroadcaster, max_fps: float = None,
+                 idle_without_viewers: bool = True):
+        """
+        :param get_frame: Called to get the next encoded frame, may return None.
+        :param broadcaster: Where to publish the frames.
+        :param max_fps: Optional cap on the number of frames produced per second.
+        :param idle_without_viewers: Whether to stop producing frames while nobody is watching.
+        """
+        self.get_frame = get_frame
+        self.broadcaster = broadcaster
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.idle_without_viewers = idle_without_viewers
+        self.thread = None
+
+    def start(self):
+        """ Starts producing frames, calling it again while running is a no-op.
+        :return: None
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name='coral-cam-producer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            if self.idle_without_viewers and self.broadcaster.viewers == 0 and self.broadcaster.frame is not None:
+                time_sleep(0.05)
+                continue
+            t0 = time()
+            try:
+                frame = self.get_frame()
+            except Exception:
+                # A bad frame must not end the feed, viewers would be stuck on the last frame until they reload.
+                traceback.print_exc()
+                time_sleep(0.01)
+                continue
+            if frame is None:
+                time_sleep(0.01)
+                continue
+            self.broadcaster.publish(frame)
+            remaining = self.min_interval - (time() - t0)
+            if remaining > 0:
+                time_sleep(remaining)
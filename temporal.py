@@ -0,0 +1,183 @@
+import threading
+
+import cv2
+import numpy as np
+
+from results import DetectionResult, PoseResult
+
+
+def _greedy_match(cost: np.ndarray, max_cost: float):
+    """ Pairs up rows and columns of a cost matrix, cheapest pairs first.
+    :param cost: The (rows, columns) cost matrix.
+    :param max_cost: Pairs costing more than this are left unmatched.
+    :return: A list of (row, column) pairs.
+    """
+    pairs = []
+    if cost.size == 0:
+        return pairs
+    used_rows, used_columns = set(), set()
+    for flat in np.argsort(cost, axis=None, kind='stable'):
+        row, column = divmod(int(flat), cost.shape[1])
+        if cost[row, column] > max_cost:
+            break
+        if row in used_rows or column in used_columns:
+            continue
+        used_rows.add(row)
+        used_columns.add(column)
+        pairs.append((row, column))
+    return pairs
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray):
+    """ Intersection over union of every pair of boxes.
+    :param boxes_a: (N, 4) boxes as (x_min, y_min, x_max, y_max).
+    :param boxes_b: (M, 4) boxes as (x_min, y_min, x_max, y_max).
+    :return: The (N, M) IoU matrix.
+    """
+    a = boxes_a[:, None, :].astype(np.float32)
+    b = boxes_b[None, :, :].astype(np.float32)
+    width = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    height = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = width * height
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-6)
+
+
+class TemporalReuse:
+    """
+    Skips inference on frames that barely differ from the last frame inference ran on, reusing its result instead.
+    Frames are compared on a small grayscale copy, which costs a fraction of a millisecond. Inference still runs at
+    least every keyframe_interval frames, and detection boxes and pose keypoints are smoothed across those keyframes
+    so the reused results don't jump around. Several threads may process the frames of a stream at once, each compares
+    its frame on buffers of its own.
+    """
+
+    def __init__(self, threshold: float = 3.0, keyframe_interval: int = 30, smoothing: float = 0.5,
+                 size: tuple = (64, 36)):
+        """
+        :param threshold: Frames whose mean absolute difference to the last keyframe, in gray levels, is at or below
+        this reuse the last result.
+        :param keyframe_interval: Inference runs at least once every this many frames.
+        :param smoothing: The weight of a new detection or pose against the one it matches, 1 disables smoothing.
+        :param size: The (width, height) frames are downscaled to before comparing them.
+        """
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.smoothing = smoothing
+        self.size = size
+        self.local = threading.local()  # Per thread small, gray and diff buffers, see _buffers().
+        self.lock = threading.Lock()  # Guards the reference and the last result.
+        self.reference = np.empty((size[1], size[0]), dtype=np.uint8)  # The small grayscale copy of the last keyframe.
+        self.engine = None  # The engine the last result came from, results of another engine are never reused.
+        self.last_result = None
+        self.last_latency = 0.0
+        self.since_keyframe = 0
+        self.score = 0.0  # Difference score of the last frame.
+        self.inferred = 0  # Number of frames inference ran on.
+        self.reused = 0  # Number of frames that reused a result.
+
+    def _buffers(self):
+        """ :return: The small, gray and diff buffers of the calling thread. """
+        local = self.local
+        if not hasattr(local, 'gray'):
+            local.small = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+            local.gray = np.empty_like(self.reference)
+            local.diff = np.empty_like(self.reference)
+        return local.small, local.gray, local.diff
+
+    def should_infer(self, image, engine):
+        """ Decides whether a frame needs inference, call it with every frame before processing it.
+        :param image: The BGR frame, before anything is drawn on it.
+        :param engine: The engine that would process the frame.
+        :return: Whether to run inference, if not draw last() instead.
+        """
+        small, gray, diff = self._buffers()
+        cv2.resize(image, self.size, dst=small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=gray)
+        with self.lock:
+            if self.last_result is None or engine is not self.engine or \
+                    self.since_keyframe + 1 >= self.keyframe_interval:
+                return True
+            cv2.absdiff(gray, self.reference, dst=diff)
+            self.score = float(cv2.mean(diff)[0])
+            if self.score > self.threshold:
+                return True
+            self.since_keyframe += 1
+            self.reused += 1
+            return False
+
+    def last(self):
+        """ :return: The last result and its invoke duration in seconds, to draw on frames that reuse it. """
+        with self.lock:
+            return self.last_result, self.last_latency
+
+    def update(self, engine, result, latency):
+        """ Records the result of a keyframe, call it after running inference on a frame should_infer() asked for, on
+        the same thread.
+        :param engine: The engine that processed the frame.
+        :param result: The decoded result, or the list of results of a MultiModelRunner.
+        :param latency: The invoke duration in seconds, or the list of durations of a MultiModelRunner.
+        :return: The result to draw, smoothed against the previous one for detections and poses.
+        """
+        _, gray, _ = self._buffers()
+        with self.lock:
+            if engine is self.engine and self.last_result is not None and self.smoothing < 1.0:
+                if isinstance(result, list):
+                    result = [self.smooth(previous, current) for previous, current in zip(self.last_result, result)]
+                else:
+                    result = self.smooth(self.last_result, result)
+            np.copyto(self.reference, gray)
+            self.engine = engine
+            self.last_result = result
+            self.last_latency = latency
+            self.since_keyframe = 0
+            self.inferred += 1
+            return result
+
+    def smooth(self, previous, current):
+        """ Smooths a detection or pose result against the previous one, other results are returned as they are.
+        :param previous: The previous result.
+        :param current: The new result.
+        :return: The smoothed result.
+        """
+        if isinstance(current, DetectionResult):
+            return self.smooth_detection(previous, current)
+        if isinstance(current, PoseResult):
+            return self.smooth_pose(previous, current)
+        return current
+
+    def smooth_detection(self, previous: DetectionResult, current: DetectionResult, min_iou: float = 0.3):
+        """ Moves each detection part of the way from the box it matches in the previous result.
+        :param previous: The previous DetectionResult.
+        :param current: The new DetectionResult.
+        :param min_iou: Boxes overlapping less than this are not the same object.
+        :return: The smoothed DetectionResult.
+        """
+        if not len(previous.boxes) or not len(current.boxes):
+            return current
+        iou = box_iou(current.boxes, previous.boxes)
+        # Only boxes of the same class can be the same object.
+        iou[current.classes[:, None] != previous.classes[None, :]] = 0.0
+        boxes = current.boxes.astype(np.float32)
+        for row, column in _greedy_match(1.0 - iou, 1.0 - min_iou):
+            boxes[row] = self.smoothing * boxes[row] + (1.0 - self.smoothing) * previous.boxes[column]
+        return current._replace(boxes=np.rint(boxes).astype(np.int32))
+
+    def smooth_pose(self, previous: PoseResult, current: PoseResult, max_distance: float = 100.0):
+        """ Moves the keypoints of each pose part of the way from the pose it matches in the previous result.
+        :param previous: The previous PoseResult.
+        :param current: The new PoseResult.
+        :param max_distance: Poses whose centers are further apart than this many pixels are not the same person.
+        :return: The smoothed PoseResult.
+        """
+        if not len(previous.keypoints) or not len(current.keypoints) or \
+                previous.keypoints.shape[1:] != current.keypoints.shape[1:]:
+            return current
+        centers_current = current.keypoints.mean(axis=1)
+        centers_previous = previous.keypoints.mean(axis=1)
+        distance = np.linalg.norm(centers_current[:, None, :] - centers_previous[None, :, :], axis=-1)
+        keypoints = current.keypoints.astype(np.float32)
+        for row, column in _greedy_match(distance, max_distance):
+            keypoints[row] = self.smoothing * keypoints[row] + (1.0 - self.smoothing) * previous.keypoints[column]
+        return current._replace(keypoints=keypoints)
@@ -22,18 +22,48 @@ function toggleSettingMenu(elt) {
 }
 
 function onStart() {
-    // Set Inference Engine
-    setInferenceEngine()
+    // Set Inference Engine, unless main.py was started with --compare and runs several models already.
+    eel.get_compare_models()(function (models) {
+        if (!models) {
+            setInferenceEngine();
+        }
+    });
     // Starts Video Feed.
-    eel.video_feed()()
+    eel.video_feed()(updateImageSrc)
+    // Polls the performance metrics.
+    setInterval(pollMetrics, 2000);
+}
+
+function pollMetrics() {
+    eel.get_metrics()(function (metrics) {
+        let parts = [];
+        const encode = metrics.stages['encode'];
+        if (encode) {
+            parts.push('fps: ' + encode.rate_fps.toFixed(1));
+        }
+        ['capture', 'invoke', 'encode', 'transport'].forEach(function (stage) {
+            if (metrics.stages[stage]) {
+                parts.push(stage + ': ' + metrics.stages[stage].p50_ms.toFixed(1) + ' ms');
+            }
+        });
+        if (metrics.bottleneck) {
+            parts.push('bottleneck: ' + metrics.bottleneck);
+        }
+        const rss = metrics.samples['process_resident_memory_bytes'];
+        if (rss) {
+            parts.push('rss: ' + (rss / (1024 * 1024)).toFixed(0) + ' MB');
+        }
+        document.getElementById('metrics-bar').textContent = parts.join(' | ');
+    });
 }
 
 
 eel.expose(updateImageSrc);
 
-function updateImageSrc(img) {
+function updateImageSrc(url) {
+    // The video feed is a binary MJPEG stream, the img tag keeps replacing its content as frames arrive.
     let elem = document.getElementById('coral-cam-video-feed');
-    elem.src = "data:image/jpeg;base64," + img;
+    elem.src = url;
 }
 
 eel.expose(updateLog);
@@ -101,6 +131,14 @@ function inferenceSelectionChanged(elt) {
         ]);
 
     }
+    modelSelectionChanged();
+}
+
+function modelSelectionChanged() {
+    // Warm up the selected model in the background so that submitting it is instant.
+    const model = document.getElementById('model-selector').value;
+    const edgetpu = document.getElementById('edgetpu-slider').checked;
+    eel.prewarm_model(model, edgetpu)
 }
 
 function setInferenceEngine() {